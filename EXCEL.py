@@ -1,35 +1,64 @@
 """
 企业级工资表智能处理与分发系统
 功能：支持任意格式Excel处理 + 智能合并 + 自定义邮件发送（含工资条附件）
+用法：python EXCEL.py                      启动图形界面
+      python EXCEL.py batch 文件或文件夹 [--formats xlsx csv parquet] [--send] [--dry-run]
+      python EXCEL.py watch [--folder 工资表收件箱]
 作者：肖松甫
 日期：2025-08-06
 """
 import os
+import io
+import argparse
 import sys
 import re
-import pandas as pd
-import numpy as np
+import codecs
+import json
+import html
+import string
+import zipfile
+import importlib
+import importlib.util
 import logging
-import smtplib
 import sqlite3
 import hashlib
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk, scrolledtext
-from datetime import datetime
-from email.mime.text import MIMEText
-from email.utils import formataddr
-from email.header import Header
-from openpyxl import load_workbook
-from openpyxl.utils import get_column_letter
-from tkinter.simpledialog import askstring
-from tqdm import tqdm
-from PIL import Image, ImageTk, ImageDraw
+from datetime import datetime, date, timedelta
+import email
 import threading
+import queue
+from contextlib import contextmanager
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from copy import copy
-from openpyxl.styles import Font, PatternFill
-from email.message import EmailMessage
 import shutil
+import subprocess
+
+
+class LazyModule:
+    """延迟导入的模块：首次访问属性时才真正导入，并把模块级同名变量换成真正的模块，之后访问没有额外开销"""
+
+    def __init__(self, name, alias=None):
+        self._name = name
+        self._alias = alias or name
+
+    def _load(self):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+# pandas、openpyxl 等导入耗时较长，图形界面先显示，用到时（或后台预加载时）再导入
+pd = LazyModule('pandas', 'pd')
+np = LazyModule('numpy', 'np')
+openpyxl = LazyModule('openpyxl')
+smtplib = LazyModule('smtplib')
+
+# 只检查 pyarrow 是否安装，不在启动时导入
+ARROW_STRING_DTYPE = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else None
 
 
 # ===================== 配置区域 =====================
@@ -46,12 +75,84 @@ class Config:
     DB_FILE = "工资发送记录.db"
     TEMP_SALARY_DIR = "临时工资条"
     DATE_FORMATS = ["%Y/%m/%d", "%Y-%m-%d", "%Y年%m月%d日", "%d/%m/%Y"]
+    DATE_SAMPLE_SIZE = 200
     NUMBER_FORMATS = [",", "，", " "]
+    NUMBER_UNITS = {"%": 0.01, "万": 1e4, "亿": 1e8}
 
     HEADER_KEYWORDS = ["姓名", "员工", "工号", "部门", "基本工资", "岗位工资", "绩效", "补贴",
                        "奖金", "扣款", "社保", "公积金", "个税", "实发工资", "银行账号", "邮箱"]
 
     HIDE_SENSITIVE_COLS = ['身份证号', '银行卡号', '银行账号']
+    SALARY_KEYWORDS = ["工资", "奖金", "补贴", "扣款", "社保", "公积金", "个税"]
+    CATEGORY_COLUMNS = ["部门", "数据来源"]
+
+    # 保存合并结果时边写边设置格式（False 时沿用 to_excel 后再 beautify_excel）
+    STREAMING_EXCEL_WRITER = True
+    PAYSLIP_IN_MEMORY = True
+
+    # CSV：编码探测读取的字节数、流式处理每块行数
+    FILE_ENCODINGS = ['utf-8', 'gbk', 'gb18030', 'latin1']
+    CSV_SNIFF_BYTES = 64 * 1024
+    CSV_CHUNKSIZE = 100000
+    # 超过该大小（MB）的CSV分块读取，逐块清洗并压缩类型后再合并
+    CSV_STREAM_MB = 100
+
+    # 并行读取工资表的进程数，1 表示在当前进程中逐个处理
+    MERGE_WORKERS = min(4, os.cpu_count() or 1)
+
+    # 监控模式：收件文件夹、扫描间隔秒数，文件大小和修改时间保持不变多少秒后才处理（避免读到未写完的文件）
+    WATCH_FOLDER = "工资表收件箱"
+    WATCH_INTERVAL = 5
+    WATCH_SETTLE_SECONDS = 10
+    WATCH_OUTPUT_NAME = "合并工资表_最新.xlsx"
+
+    # 处理结果缓存：文件内容和清洗规则都没变时直接读取上次的结果；修改清洗逻辑后请递增 CLEANING_RULES_VERSION
+    FILE_CACHE = True
+    CLEANING_RULES_VERSION = 1
+    CACHE_DIR = os.path.join(OUTPUT_FOLDER, "处理缓存")
+    CACHE_MAX_MB = 500
+    RENDER_WORKERS = min(4, os.cpu_count() or 1)
+    RENDER_CHUNK_ROWS = 500
+
+    # SMTP：连接超时、空闲多少秒后先 NOOP 检查、每个连接发送多少封后重新登录
+    SMTP_TIMEOUT = 30
+    SMTP_NOOP_AFTER = 30
+    SMTP_ROTATE_AFTER = 50
+    # 并行发送的连接数（公共邮箱通常限制并发，企业中继可调大；smtp_config 中可用 workers 覆盖）
+    SMTP_WORKERS = 1
+
+    # 发送记录（DB_FILE）：攒够多少条或间隔多少秒写入一次
+    LEDGER_BATCH_SIZE = 50
+    LEDGER_FLUSH_SECONDS = 2
+    # 发送流水线中已生成、待组装的工资条最多缓存多少份
+    PIPELINE_QUEUE_SIZE = 32
+    # 邮件正文模板（HTML，占位符见 DEFAULT_EMAIL_TEMPLATE），文件不存在时使用内置模板
+    EMAIL_TEMPLATE_FILE = "工资条邮件模板.html"
+    EMAIL_PATTERN = r"[^@\s]+@[^@\s]+\.[^@\s]+"
+
+    # 发件箱模式：先把邮件写成 .eml 文件（pending/），再单独发送（成功移入 sent/，永久失败移入 failed/）
+    OUTBOX_MODE = False
+    OUTBOX_DIR = "工资条发件箱"
+    OUTBOX_MAX_ATTEMPTS = 5
+    # 关闭窗口时等待后台任务结束（写完发送记录、关闭连接）的最长秒数
+    CLOSE_WAIT_SECONDS = 2 * SMTP_TIMEOUT
+
+    # 各服务商的发送限速（每分钟、每天），未列出的服务器使用 SMTP_DEFAULT_RATE；
+    # 数值为保守估计，可按实际套餐调整，也可在 smtp_config 中用 per_minute/per_day 覆盖
+    SMTP_RATE_PROFILES = {
+        "smtp.qq.com": {"per_minute": 10, "per_day": 500},
+        "smtp.exmail.qq.com": {"per_minute": 20, "per_day": 1000},
+        "smtp.163.com": {"per_minute": 10, "per_day": 200},
+        "smtp.126.com": {"per_minute": 10, "per_day": 200},
+        "smtp.gmail.com": {"per_minute": 20, "per_day": 500},
+        "smtp.office365.com": {"per_minute": 30, "per_day": 10000},
+    }
+    SMTP_DEFAULT_RATE = {"per_minute": 4, "per_day": None}
+    # 服务器返回限流回复时的退避：起始秒数、上限秒数、每封邮件最多重试次数
+    SMTP_THROTTLE_CODES = (421, 450, 451)
+    SMTP_BACKOFF_START = 30
+    SMTP_BACKOFF_MAX = 600
+    SMTP_THROTTLE_RETRIES = 3
 
 
 # ===================== 日志系统 =====================
@@ -72,45 +173,101 @@ def setup_logging():
     return logger
 
 
+logger = logging.getLogger()
+
+
 # ===================== 文件处理工具 =====================
-def detect_file_encoding(file_path):
-    """检测文件编码"""
-    encodings = ['utf-8', 'gbk', 'gb18030', 'latin1']
-    for encoding in encodings:
+def is_header_row(row):
+    """判断一行单元格是否包含表头关键字"""
+    row_text = " ".join(str(value).strip() for value in row if value)
+    return any(keyword in row_text for keyword in Config.HEADER_KEYWORDS)
+
+
+def sniff_csv(file_path):
+    """只读取一次文件开头，同时识别CSV编码与表头行，返回 (编码, 表头行号)"""
+    with open(file_path, 'rb') as f:
+        head = f.read(Config.CSV_SNIFF_BYTES)
+
+    encoding, text = 'utf-8', None
+    for candidate in Config.FILE_ENCODINGS:
         try:
-            with open(file_path, 'r', encoding=encoding) as f:
-                f.read(1024)
-            return encoding
+            # 增量解码器允许开头片段在多字节字符中间截断
+            text = codecs.getincrementaldecoder(candidate)().decode(head)
+            encoding = candidate
+            break
         except UnicodeDecodeError:
             continue
-    return 'utf-8'
+    if text is None:
+        text = head.decode(encoding, errors='replace')
 
+    for i, line in enumerate(text.split('\n')[:20]):
+        if any(keyword in line for keyword in Config.HEADER_KEYWORDS):
+            return encoding, i
+    return encoding, 0
 
-def find_data_start_row(file_path):
-    """智能定位数据起始行"""
-    if file_path.lower().endswith(('.xlsx', '.xls')):
-        wb = load_workbook(file_path, read_only=True)
-        ws = wb.active
 
-        for row_idx in range(1, 50):
-            row_values = []
-            for col_idx in range(1, ws.max_column + 1):
-                cell_value = ws.cell(row=row_idx, column=col_idx).value
-                if cell_value:
-                    row_values.append(str(cell_value).strip())
+def read_excel_streaming(file_path):
+    """单次流式读取xlsx：逐行扫描定位表头，并用同一次读取的数据构建DataFrame"""
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        scanned = []
+        header = None
+        for row in rows:
+            if is_header_row(row):
+                header = row
+                logger.info(f"检测到数据起始行: {len(scanned) + 1}")
+                break
+            scanned.append(row)
+            if len(scanned) >= 49:
+                break
+
+        if header is None:
+            # 前49行都找不到表头时以第一行为表头
+            if not scanned:
+                return pd.DataFrame()
+            header, data = scanned[0], scanned[1:]
+        else:
+            data = []
+        data.extend(rows)
+    finally:
+        wb.close()
+
+    # 与 pd.read_excel 一致：去掉每行末尾的空单元格和表格末尾的空行
+    width, last_row = 0, -1
+    for row_idx, row in enumerate([header] + data):
+        length = len(row)
+        while length and row[length - 1] is None:
+            length -= 1
+        if length:
+            width, last_row = max(width, length), row_idx
+    data = data[:max(last_row, 0)]
+
+    columns, seen = [], {}
+    for col_idx in range(width):
+        name = header[col_idx] if col_idx < len(header) else None
+        if name is None:
+            name = f"Unnamed: {col_idx}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+
+    df = pd.DataFrame([row[:width] for row in data], columns=range(len(columns)))
+    df = df.reindex(columns=range(len(columns)))
+    df.columns = columns
 
-            if any(keyword in " ".join(row_values) for keyword in Config.HEADER_KEYWORDS):
-                return row_idx
-        return 1
-    elif file_path.lower().endswith('.csv'):
-        encoding = detect_file_encoding(file_path)
-        with open(file_path, 'r', encoding=encoding) as f:
-            for i in range(20):
-                line = f.readline()
-                if any(keyword in line for keyword in Config.HEADER_KEYWORDS):
-                    return i
-        return 0
-    return 1
+    # 与 pd.read_excel 一致：全空列为浮点列，整列都是整数值的浮点列还原为整数
+    empty = df.columns[df.isna().all().to_numpy()]
+    if len(empty):
+        df[empty] = df[empty].astype('float64')
+    for col in df.columns[df.dtypes == 'float64']:
+        values = df[col]
+        if values.notna().all() and (values % 1 == 0).all():
+            df[col] = values.astype('int64')
+    return df
 
 
 def clean_column_name(name):
@@ -165,21 +322,68 @@ def convert_to_number(value):
         for sep in Config.NUMBER_FORMATS:
             value = value.replace(sep, '')
 
-        value = re.sub(r'[万亿]', '', value)
+        scale = 1.0
+        if value[-1:] in Config.NUMBER_UNITS:
+            scale = Config.NUMBER_UNITS[value[-1:]]
+            value = value[:-1]
 
         try:
-            return float(value)
+            return float(value) * scale
         except ValueError:
             pass
-
-        if '%' in value:
-            try:
-                return float(value.replace('%', '')) / 100
-            except ValueError:
-                pass
     return 0.0
 
 
+def convert_number_column(series):
+    """按列批量转换数字（convert_to_number 的向量化版本）"""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('float64').fillna(0.0)
+
+    # 工资列重复值很多，先按取值去重，只解析不同的值；缺失值编码为 -1
+    codes, uniques = pd.factorize(series)
+    if len(uniques) == 0:
+        return pd.Series(np.zeros(len(series)), index=series.index, name=series.name)
+    raw = np.asarray(uniques, dtype=object)
+    text = raw.astype(str)
+
+    for sep in Config.NUMBER_FORMATS:
+        hit = np.char.find(text, sep) >= 0
+        if hit.any():
+            text[hit] = np.char.replace(text[hit], sep, '')
+
+    # 末尾单位（%/万/亿）只认一个，按比例换算
+    scale = np.ones(len(text))
+    for unit, factor in Config.NUMBER_UNITS.items():
+        scale[np.char.endswith(text, unit)] = factor
+    length = np.char.str_len(text)
+    text = np.char.rstrip(text, ''.join(Config.NUMBER_UNITS))
+    single_unit = length - np.char.str_len(text) <= 1
+
+    # 去掉符号与一个小数点后应只剩十进制数字（isdigit 会放过 ①、² 这类 float() 不认的字符）
+    unsigned = np.char.lstrip(text, '+-')
+    digits = np.char.replace(unsigned, '.', '', 1)
+    valid = (
+        single_unit
+        & (np.char.str_len(text) - np.char.str_len(unsigned) <= 1)
+        & np.char.isdecimal(digits)
+    )
+
+    parsed = np.zeros(len(text))
+    try:
+        parsed[valid] = text[valid].astype(np.float64) * scale[valid]
+    except ValueError:
+        # 批量解析失败时不影响整个文件，逐个回退
+        parsed[valid] = [convert_to_number(value) for value in raw[valid]]
+
+    # 科学计数法等少见写法逐个回退到 convert_to_number
+    retry = ~valid & ((np.char.find(text, 'e') >= 0) | (np.char.find(text, 'E') >= 0))
+    if retry.any():
+        parsed[retry] = [convert_to_number(value) for value in raw[retry]]
+
+    values = np.where(codes >= 0, parsed[codes], 0.0)
+    return pd.Series(values, index=series.index, name=series.name)
+
+
 def convert_to_date(value):
     """将各种格式转换为日期"""
     if pd.isna(value) or value is None:
@@ -199,6 +403,59 @@ def convert_to_date(value):
     return None
 
 
+# 列名 -> 推断出的日期格式，相同版式的文件直接复用
+DATE_FORMAT_CACHE = {}
+
+
+def infer_date_format(sample):
+    """根据样本推断日期列最匹配的格式"""
+    best_format, best_hits = None, 0
+    for fmt in Config.DATE_FORMATS:
+        hits = pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum()
+        if hits > best_hits:
+            best_format, best_hits = fmt, hits
+    return best_format
+
+
+def convert_date_column(series):
+    """按列批量转换日期（convert_to_date 的向量化版本）"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.date.astype(object).where(series.notna(), None)
+
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.Series([None] * len(series), index=series.index, name=series.name, dtype=object)
+
+    try:
+        stripped = series.str.strip()
+    except AttributeError:
+        # 整列没有文本（如全是日期对象），无需推断格式
+        stripped = pd.Series(np.nan, index=series.index, dtype=object)
+    is_text = stripped.notna()
+    values = stripped.where(is_text, series)
+
+    sample = stripped[is_text].head(Config.DATE_SAMPLE_SIZE)
+    fmt = DATE_FORMAT_CACHE.get(series.name)
+    if len(sample) and (fmt is None or
+                        pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum() * 2 < len(sample)):
+        fmt = infer_date_format(sample) or fmt
+        DATE_FORMAT_CACHE[series.name] = fmt
+
+    # 日期列重复值很多，只解析不同的取值；缺失值编码为 -1
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+    parsed = pd.to_datetime(pd.Series(uniques), format=fmt or Config.DATE_FORMATS[0], errors='coerce')
+    dates = parsed.dt.date.astype(object).where(parsed.notna(), None).to_numpy(copy=True)
+
+    # 与推断格式不符的取值逐个回退到 convert_to_date
+    failed = parsed.isna().to_numpy()
+    if failed.any():
+        dates[failed] = [convert_to_date(value) for value in uniques[failed]]
+
+    result = np.full(len(series), None, dtype=object)
+    result[codes >= 0] = dates[codes[codes >= 0]]
+    return pd.Series(result, index=series.index, name=series.name)
+
+
 def anonymize_data(value):
     """数据脱敏处理"""
     if pd.isna(value) or value is None:
@@ -213,28 +470,171 @@ def anonymize_data(value):
     return value
 
 
+def mask_middle(text, head, stars):
+    """保留定长字符串数组的前head位与后4位，中间替换为stars"""
+    width = text.dtype.itemsize // 4
+    chars = text.view('U1').reshape(len(text), width)
+    tail_index = np.char.str_len(text)[:, None] - 4 + np.arange(4)
+    tail = chars[np.arange(len(text))[:, None], tail_index].copy().view('U4').ravel()
+    return np.char.add(np.char.add(text.astype(f'U{head}'), stars), tail)
+
+
+def anonymize_column(series):
+    """按列批量脱敏（anonymize_data 的向量化版本）"""
+    text = series.to_numpy(dtype=object).astype(str)
+    text[series.isna().to_numpy()] = ""
+
+    length = np.char.str_len(text)
+    bank_card = (length > 8) & np.char.isdigit(text)
+    id_card = ~bank_card & (length > 10) & (
+        (np.char.find(text, 'X') >= 0) | (np.char.find(text, 'x') >= 0))
+
+    # 脱敏后最长18位，先在定长数组上改写，最后统一转成Python字符串
+    result = text.astype(f'U{max(text.dtype.itemsize // 4, 18)}')
+    if bank_card.any():
+        result[bank_card] = mask_middle(text[bank_card], 4, "****")
+    if id_card.any():
+        result[id_card] = mask_middle(text[id_card], 3, "***********")
+    return pd.Series(result.astype(object), index=series.index, name=series.name)
+
+
+def get_column_converter(col):
+    """根据列名选择类型转换函数，无需转换时返回None"""
+    if any(keyword in col for keyword in Config.SALARY_KEYWORDS):
+        return convert_number_column
+    elif "日期" in col or "时间" in col:
+        return convert_date_column
+    elif any(keyword in col for keyword in Config.HIDE_SENSITIVE_COLS):
+        return anonymize_column
+    return None
+
+
+def convert_column_types(df):
+    """一次遍历完成数字、日期转换与敏感信息脱敏，每列只处理一次"""
+    converted = {}
+    for col in df.columns:
+        converter = get_column_converter(col)
+        if converter:
+            converted[col] = converter(df[col])
+    if converted:
+        df = df.assign(**converted)
+    return df
+
+
+# ===================== 处理结果缓存 =====================
+def cleaning_rules_digest():
+    """清洗规则指纹：规则版本号加上影响解析结果的配置项"""
+    rules = [
+        Config.CLEANING_RULES_VERSION, Config.DATE_FORMATS, Config.NUMBER_FORMATS,
+        sorted(Config.NUMBER_UNITS.items()), Config.HEADER_KEYWORDS, Config.HIDE_SENSITIVE_COLS,
+        Config.SALARY_KEYWORDS
+    ]
+    return hashlib.sha256(repr(rules).encode('utf-8')).hexdigest()
+
+
+def file_cache_key(file_path):
+    """缓存键：文件内容的哈希加清洗规则指纹"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    digest.update(cleaning_rules_digest().encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_cached_frame(key):
+    """读取缓存的处理结果，没有缓存时返回 None"""
+    for ext in ('.parquet', '.pkl'):
+        path = os.path.join(Config.CACHE_DIR, key + ext)
+        if not os.path.exists(path):
+            continue
+        try:
+            df = pd.read_parquet(path) if ext == '.parquet' else pd.read_pickle(path)
+            # 更新修改时间，淘汰时按最近使用排序
+            os.utime(path, None)
+            return df
+        except Exception as e:
+            logger.warning(f"缓存文件损坏，已忽略: {path} - {str(e)}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return None
+
+
+def store_cached_frame(key, df):
+    """保存处理结果：有 pyarrow 时用 Parquet，列中类型混杂等无法写入时退回 pickle"""
+    try:
+        os.makedirs(Config.CACHE_DIR, exist_ok=True)
+        path = os.path.join(Config.CACHE_DIR, key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            if ARROW_STRING_DTYPE is None:
+                raise ImportError("pyarrow 未安装")
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path + '.parquet')
+        except Exception:
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path + '.pkl')
+        evict_cache()
+    except Exception as e:
+        logger.warning(f"写入缓存失败: {str(e)}")
+
+
+def evict_cache(max_mb=None):
+    """缓存总大小超过上限时，按最近使用时间从旧到新删除"""
+    max_bytes = (max_mb or Config.CACHE_MAX_MB) * 1024 * 1024
+    entries = []
+    for name in os.listdir(Config.CACHE_DIR):
+        if name.endswith(('.parquet', '.pkl')):
+            path = os.path.join(Config.CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = 0
+    for _, size, path in sorted(entries, reverse=True):
+        total += size
+        if total > max_bytes:
+            try:
+                os.remove(path)
+                logger.info(f"清理缓存: {os.path.basename(path)}")
+            except OSError:
+                pass
+
+
 # ===================== 核心处理功能 =====================
-def process_single_file(file_path):
+class JobCancelled(Exception):
+    """任务被用户取消"""
+
+
+def check_cancelled(cancel_event):
+    """cancel_event 已设置时抛出 JobCancelled，供耗时任务在循环中调用"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled("任务已取消")
+
+
+def process_single_file(file_path, raise_errors=False):
     """处理单个工资表文件"""
     logger.info(f"开始处理文件: {os.path.basename(file_path)}")
     try:
 
-        start_row = find_data_start_row(file_path)
-        logger.info(f"检测到数据起始行: {start_row}")
-
         if file_path.lower().endswith(('.xlsx', '.xls')):
 
-            df = pd.read_excel(
-                file_path,
-                header=start_row - 1 if start_row > 0 else None,
-                engine='openpyxl'
-            )
+            df = read_excel_streaming(file_path)
         elif file_path.lower().endswith('.csv'):
+            if os.path.getsize(file_path) >= Config.CSV_STREAM_MB * 1024 * 1024:
+                df = read_csv_streaming(file_path)
+                logger.info(f"文件处理完成: {len(df)}条记录")
+                return df
 
-            encoding = detect_file_encoding(file_path)
+            encoding, start_row = sniff_csv(file_path)
+            logger.info(f"检测到数据起始行: {start_row}, 编码: {encoding}")
             df = pd.read_csv(
                 file_path,
-                header=start_row,
+                skiprows=start_row,
                 encoding=encoding,
                 on_bad_lines='skip'
             )
@@ -245,16 +645,7 @@ def process_single_file(file_path):
         df.columns = [clean_column_name(col) for col in df.columns]
         logger.info(f"清洗后列名: {list(df.columns)}")
 
-        for col in df.columns:
-
-            if any(keyword in col for keyword in ["工资", "奖金", "补贴", "扣款", "社保", "公积金", "个税"]):
-                df[col] = df[col].apply(convert_to_number)
-
-            elif "日期" in col or "时间" in col:
-                df[col] = df[col].apply(convert_to_date)
-
-            elif any(keyword in col for keyword in Config.HIDE_SENSITIVE_COLS):
-                df[col] = df[col].apply(anonymize_data)
+        df = convert_column_types(df)
 
         filename = os.path.splitext(os.path.basename(file_path))[0]
         df['数据来源'] = filename
@@ -262,72 +653,312 @@ def process_single_file(file_path):
         return df
     except Exception as e:
         logger.error(f"处理文件失败: {file_path} - {str(e)}")
+        if raise_errors:
+            raise
         return None
 
 
-def merge_all_files(file_paths):
-    """合并所有工资表文件"""
+def iter_csv_chunks(file_path, chunksize=None):
+    """只识别一次编码与表头行，分块读取CSV并逐块清洗列名、转换类型"""
+    encoding, start_row = sniff_csv(file_path)
+    logger.info(f"流式处理CSV: {os.path.basename(file_path)} (表头行: {start_row}, 编码: {encoding})")
+
+    source = os.path.splitext(os.path.basename(file_path))[0]
+    reader = pd.read_csv(
+        file_path,
+        skiprows=start_row,
+        encoding=encoding,
+        on_bad_lines='skip',
+        chunksize=chunksize or Config.CSV_CHUNKSIZE
+    )
+    with reader:
+        for chunk in reader:
+            chunk.columns = [clean_column_name(col) for col in chunk.columns]
+            chunk = convert_column_types(chunk)
+            chunk['数据来源'] = source
+            yield chunk
+
+
+def read_csv_streaming(file_path, chunksize=None):
+    """分块读取大CSV：每块清洗后先压缩数据类型再合并，原始文本同一时间只保留一块"""
+    chunks = [compact_dtypes(chunk) for chunk in iter_csv_chunks(file_path, chunksize)]
+    if not chunks:
+        return pd.DataFrame()
+    return merge_frames(chunks)
+
+
+def process_csv_streaming(file_path, output_path, chunksize=None):
+    """分块流式处理大CSV：逐块清洗、类型转换后追加写出，内存占用与文件大小无关"""
+    total = 0
+    with open(output_path, 'w', encoding='utf-8-sig', newline='') as out:
+        for chunk_idx, chunk in enumerate(iter_csv_chunks(file_path, chunksize)):
+            chunk.to_csv(out, index=False, header=chunk_idx == 0)
+            total += len(chunk)
+            logger.info(f"已写出 {total} 条记录")
+    logger.info(f"流式处理完成: {total}条记录 -> {output_path}")
+    return total
+
+
+def process_file_task(file_path, store_cache=True):
+    """处理单个文件并记录耗时与错误（可在子进程中运行），文件未变化时读取缓存；store_cache=False 时不写入缓存"""
+    start = time.perf_counter()
+    cached = False
+    try:
+        key = file_cache_key(file_path) if Config.FILE_CACHE else None
+        df = load_cached_frame(key) if key else None
+        if df is not None:
+            cached = True
+            df['数据来源'] = os.path.splitext(os.path.basename(file_path))[0]
+            logger.info(f"文件未变化，使用缓存: {os.path.basename(file_path)} ({len(df)}条)")
+        else:
+            df = process_single_file(file_path, raise_errors=True)
+            if df is not None and key and store_cache:
+                store_cached_frame(key, df)
+        error = None if df is not None else "不支持的文件格式"
+    except Exception as e:
+        df, error = None, str(e)
+    return {
+        'file': file_path,
+        'df': df,
+        'rows': 0 if df is None else len(df),
+        'seconds': time.perf_counter() - start,
+        'cached': cached,
+        'error': error
+    }
+
+
+def ingest_files(file_paths, workers=None, cancel_event=None, store_cache=True):
+    """处理多个工资表文件，workers>1 时使用进程池并行，结果按输入顺序返回；取消时抛出 JobCancelled"""
+    if workers is None:
+        workers = Config.MERGE_WORKERS
+    workers = max(1, min(workers, len(file_paths)))
+
+    if workers == 1:
+        results = []
+        for file_path in file_paths:
+            check_cancelled(cancel_event)
+            results.append(process_file_task(file_path, store_cache))
+        return results
+
+    logger.info(f"使用 {workers} 个进程并行处理 {len(file_paths)} 个文件")
+    results = []
+    executor = ProcessPoolExecutor(max_workers=workers)
+    cancelled = False
+    try:
+        futures = [executor.submit(process_file_task, file_path, store_cache) for file_path in file_paths]
+        for file_path, future in zip(file_paths, futures):
+            while True:
+                try:
+                    results.append(future.result(timeout=0.5))
+                    break
+                except FutureTimeoutError:
+                    # 等待期间定期检查是否已取消（Python 3.11 之前 future 超时不是内置 TimeoutError）
+                    check_cancelled(cancel_event)
+                except Exception as e:
+                    # 子进程异常退出或结果无法回传
+                    results.append({'file': file_path, 'df': None, 'rows': 0, 'seconds': 0.0, 'cached': False,
+                                    'error': str(e)})
+                    break
+            check_cancelled(cancel_event)
+    except JobCancelled:
+        cancelled = True
+        raise
+    finally:
+        # 取消时不等待正在处理的文件，子进程处理完当前文件后退出
+        executor.shutdown(wait=not cancelled, cancel_futures=True)
+    return results
+
+
+def merge_all_files(file_paths, workers=None, report=None, cancel_event=None, store_cache=True):
+    """合并所有工资表文件，report 为列表时追加每个文件的行数、耗时与错误；取消时抛出 JobCancelled"""
     if not file_paths:
         logger.error("没有选择任何文件")
         return None
-    all_dfs = []
-    for file_path in file_paths:
-        df = process_single_file(file_path)
-        if df is not None and not df.empty:
-            all_dfs.append(df)
+
+    results = ingest_files(list(file_paths), workers, cancel_event, store_cache)
+    cache_hits = sum(1 for result in results if result['cached'])
+    if cache_hits:
+        logger.info(f"缓存命中 {cache_hits}/{len(results)} 个文件，仅重新处理 {len(results) - cache_hits} 个")
+    for result in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        logger.info(f"文件耗时 {result['seconds']:.2f}s: {os.path.basename(result['file'])} ({result['rows']}条)")
+    failed = [result for result in results if result['error']]
+    for result in failed:
+        logger.error(f"文件处理失败: {result['file']} - {result['error']}")
+    if report is not None:
+        report.extend({key: value for key, value in result.items() if key != 'df'} for result in results)
+
+    all_dfs = [result['df'] for result in results if result['df'] is not None and not result['df'].empty]
     if not all_dfs:
         logger.error("所有文件处理失败")
         return None
 
     try:
-
-        all_columns = set()
-        for df in all_dfs:
-            all_columns.update(df.columns)
-
-        for df in all_dfs:
-            for col in all_columns:
-                if col not in df.columns:
-                    df[col] = np.nan
-
-        merged_df = pd.concat(all_dfs, ignore_index=True)
-
-        merged_df.fillna(0, inplace=True)
-        logger.info(f"合并完成! 总记录数: {len(merged_df)}")
+        merged_df = merge_frames(all_dfs)
+        memory_mb = merged_df.memory_usage(deep=True).sum() / 1024 / 1024
+        logger.info(f"合并完成! 总记录数: {len(merged_df)}, 内存占用: {memory_mb:.1f}MB")
         return merged_df
     except Exception as e:
         logger.error(f"合并失败: {str(e)}")
         return None
 
 
-def save_merged_data(df, output_folder):
-    """保存合并后的数据"""
+def merge_frames(dfs):
+    """按列的并集一次性合并，再按列类型压缩数据类型"""
+    return compact_dtypes(pd.concat(dfs, ignore_index=True, sort=False))
+
+
+def compact_dtypes(merged_df):
+    """按列类型选择紧凑的数据类型和缺失值填充规则"""
+    compacted = {}
+    for col in merged_df.columns:
+        values = merged_df[col]
+        converter = get_column_converter(col)
+        if col in Config.CATEGORY_COLUMNS:
+            compacted[col] = values.fillna("").astype('category')
+        elif converter is convert_number_column:
+            # 工资类列缺失视为0
+            compacted[col] = values.fillna(0.0).astype('float64')
+        elif converter is convert_date_column:
+            continue
+        elif pd.api.types.is_bool_dtype(values):
+            compacted[col] = values.astype('boolean')
+        elif pd.api.types.is_numeric_dtype(values):
+            # 工号等数值列保留缺失值，使用可空整数/浮点类型
+            compacted[col] = values.convert_dtypes(convert_string=False, convert_boolean=False)
+        elif values.dtype == object and ARROW_STRING_DTYPE and \
+                pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            # 姓名、邮箱等文本列保留缺失值，有 pyarrow 时改用连续存储的字符串类型
+            compacted[col] = values.astype(ARROW_STRING_DTYPE)
+    return merged_df.assign(**compacted)
+
+
+def save_merged_data(df, output_folder, streaming=None, cancel_event=None):
+    """保存合并后的数据；取消时删除未写完的文件并抛出 JobCancelled"""
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_path = os.path.join(output_folder, f"合并工资表_{timestamp}.xlsx")
+    if streaming is None:
+        streaming = Config.STREAMING_EXCEL_WRITER
 
     try:
+        if streaming:
+            write_excel_formatted(df, output_path, cancel_event)
+            logger.info(f"合并结果保存至: {output_path}")
+            return output_path
+
         df.to_excel(output_path, index=False)
         logger.info(f"合并结果保存至: {output_path}")
 
+        check_cancelled(cancel_event)
         beautify_excel(output_path)
         return output_path
+    except JobCancelled:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        logger.info("保存已取消")
+        raise
     except Exception as e:
         logger.error(f"保存失败: {str(e)}")
         return None
 
 
+def export_merged_data(df, output_folder, formats=("xlsx",)):
+    """按格式导出合并结果（xlsx/csv/parquet），返回 {格式: 路径}，失败的格式不在结果中"""
+    os.makedirs(output_folder, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    outputs = {}
+    for fmt in formats:
+        if fmt == "xlsx":
+            output_path = save_merged_data(df, output_folder)
+            if output_path:
+                outputs[fmt] = output_path
+            continue
+
+        output_path = os.path.join(output_folder, f"合并工资表_{timestamp}.{fmt}")
+        try:
+            if fmt == "csv":
+                df.to_csv(output_path, index=False, encoding='utf-8-sig')
+            elif fmt == "parquet":
+                df.to_parquet(output_path, index=False)
+            else:
+                raise ValueError(f"不支持的导出格式: {fmt}")
+            logger.info(f"合并结果保存至: {output_path}")
+            outputs[fmt] = output_path
+        except Exception as e:
+            logger.error(f"导出{fmt}失败: {str(e)}")
+    return outputs
+
+
+def write_excel_formatted(df, output_path, cancel_event=None):
+    """以 write_only 模式一次写出Excel，写入时即设置表头样式、数字格式和列宽"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+
+    # 列宽公式与 beautify_excel 一致，但按整列字符串长度向量化计算；须在写入行之前设置
+    for col_idx, col in enumerate(df.columns, 1):
+        max_length = len(str(col))
+        if len(df):
+            max_length = max(max_length, int(df[col].astype(str).str.len().max()))
+        ws.column_dimensions[openpyxl.utils.get_column_letter(col_idx)].width = (max_length + 2) * 1.2
+
+    header_font = openpyxl.styles.Font(bold=True)
+    header_fill = openpyxl.styles.PatternFill("solid", fgColor="DDDDDD")
+    header = []
+    for col in df.columns:
+        cell = openpyxl.cell.WriteOnlyCell(ws, value=str(col))
+        cell.font = header_font
+        cell.fill = header_fill
+        header.append(cell)
+    ws.append(header)
+
+    # 数值列每列复用一个带数字格式的单元格：write_only 下每行 append 时即写出
+    columns, number_cells, mixed_cols = [], [], []
+    for col_idx, col in enumerate(df.columns):
+        values = df[col]
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            cell = openpyxl.cell.WriteOnlyCell(ws)
+            cell.number_format = '#,##0.00'
+            number_cells.append((col_idx, cell))
+        elif values.dtype == object:
+            mixed_cols.append(col_idx)
+
+    try:
+        for row_idx, values in enumerate(zip(*columns)):
+            if row_idx % 1000 == 0:
+                check_cancelled(cancel_event)
+            row = list(values)
+            for col_idx, cell in number_cells:
+                if row[col_idx] is not None:
+                    cell.value = row[col_idx]
+                    row[col_idx] = cell
+            for col_idx in mixed_cols:
+                value = row[col_idx]
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    cell = openpyxl.cell.WriteOnlyCell(ws, value=value)
+                    cell.number_format = '#,##0.00'
+                    row[col_idx] = cell
+            ws.append(row)
+    except JobCancelled:
+        # 先结束工作表的写入，openpyxl 回收未写完的工作表时才不会报错
+        ws.close()
+        raise
+
+    wb.save(output_path)
+    logger.info("Excel格式设置完成")
+
+
 def beautify_excel(file_path):
     """美化Excel格式"""
     try:
-        wb = load_workbook(file_path)
+        wb = openpyxl.load_workbook(file_path)
         ws = wb.active
 
         for col_idx in range(1, ws.max_column + 1):
             max_length = 0
-            column = get_column_letter(col_idx)
+            column = openpyxl.utils.get_column_letter(col_idx)
             for cell in ws[column]:
                 try:
                     if len(str(cell.value)) > max_length:
@@ -341,7 +972,7 @@ def beautify_excel(file_path):
             new_font = copy(cell.font)
             new_font.bold = True
             cell.font = new_font
-            cell.fill = PatternFill("solid", fgColor="DDDDDD")
+            cell.fill = openpyxl.styles.PatternFill("solid", fgColor="DDDDDD")
 
         for row in ws.iter_rows(min_row=2):
             for cell in row:
@@ -354,72 +985,495 @@ def beautify_excel(file_path):
         logger.warning(f"Excel美化失败: {str(e)}")
 
 
+def open_folder(path):
+    """用系统文件管理器打开文件夹，无图形环境时只记录日志"""
+    try:
+        if sys.platform.startswith('win'):
+            os.startfile(path)
+        elif sys.platform == 'darwin':
+            subprocess.Popen(['open', path])
+        else:
+            subprocess.Popen(['xdg-open', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except Exception as e:
+        logger.warning(f"无法打开文件夹 {path}: {str(e)}")
 
-def generate_employee_salary_sheet(employee_data, temp_dir=Config.TEMP_SALARY_DIR):
-    """生成单个员工的工资条Excel文件（修复工号不存在的问题）"""
-
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
 
+# ===================== 监控文件夹 =====================
+def list_payroll_files(folder):
+    """列出文件夹中的工资表文件，跳过 Office 锁文件和隐藏文件"""
+    paths = []
+    for name in os.listdir(folder):
+        if name.startswith(('~$', '.')) or not name.lower().endswith(('.xlsx', '.xls', '.csv')):
+            continue
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            paths.append(path)
+    return sorted(paths)
+
+
+class FolderWatcher:
+    """轮询收件文件夹：文件新增或变化后，大小和修改时间稳定 settle_seconds 秒才交给处理"""
+
+    def __init__(self, folder, settle_seconds=None):
+        self.folder = folder
+        self.settle_seconds = Config.WATCH_SETTLE_SECONDS if settle_seconds is None else settle_seconds
+        # 已处理文件的 (大小, 修改时间)，以及变化中文件的 (大小, 修改时间, 首次看到该状态的时间)
+        self.processed = {}
+        self.pending = {}
+
+    def poll(self, now=None):
+        """扫描一次，返回 (可以处理的文件, 已删除的文件)"""
+        now = time.time() if now is None else now
+        current = {}
+        for path in list_payroll_files(self.folder):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            current[path] = (stat.st_size, stat.st_mtime_ns, stat.st_mtime)
 
-    emp_name = employee_data.get('姓名', '未知')
+        ready = []
+        for path, (size, mtime_ns, mtime) in current.items():
+            signature = (size, mtime_ns)
+            if self.processed.get(path) == signature:
+                self.pending.pop(path, None)
+                continue
+            seen = self.pending.get(path)
+            if seen is None or seen[:2] != signature:
+                seen = (size, mtime_ns, now)
+                self.pending[path] = seen
+            # 两次扫描间大小和修改时间都没变，且最后一次写入已过去足够久；
+            # 复制时保留原修改时间的文件靠前一个条件等待写完
+            if now - seen[2] >= self.settle_seconds and now - mtime >= self.settle_seconds:
+                ready.append(path)
+
+        removed = [path for path in self.processed if path not in current]
+        for path in removed:
+            del self.processed[path]
+        for path in [path for path in self.pending if path not in current]:
+            del self.pending[path]
+        return ready, removed
+
+    def mark_processed(self, path):
+        """记录文件处理时的状态，之后只有再次变化才会重新处理"""
+        seen = self.pending.pop(path, None)
+        if seen is not None:
+            self.processed[path] = seen[:2]
+
+
+class IncrementalMerge:
+    """按文件保存处理结果，文件变化时只替换该文件的数据并重新合并"""
+
+    def __init__(self):
+        self.frames = {}
+
+    def update(self, results):
+        """应用 process_file_task 的结果，返回是否有变化"""
+        changed = False
+        for result in results:
+            if result['error']:
+                logger.error(f"文件处理失败: {result['file']} - {result['error']}")
+                changed = self.frames.pop(result['file'], None) is not None or changed
+            else:
+                self.frames[result['file']] = result['df']
+                changed = True
+        return changed
+
+    def remove(self, paths):
+        """移除已删除文件的数据，返回是否有变化"""
+        return any([self.frames.pop(path, None) is not None for path in paths])
+
+    def merged(self):
+        """按文件名顺序合并当前所有文件的数据"""
+        dfs = [self.frames[path] for path in sorted(self.frames) if not self.frames[path].empty]
+        return merge_frames(dfs) if dfs else None
+
+
+def save_watch_output(df, output_folder, name=None):
+    """把最新合并结果写到固定文件名，先写临时文件再替换，避免读到写了一半的文件"""
+    os.makedirs(output_folder, exist_ok=True)
+    output_path = os.path.join(output_folder, name or Config.WATCH_OUTPUT_NAME)
+    tmp_path = output_path + '.tmp.xlsx'
+    try:
+        write_excel_formatted(df, tmp_path)
+        os.replace(tmp_path, output_path)
+        return output_path
+    except Exception as e:
+        logger.error(f"保存失败: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
 
 
-    if '工号' in employee_data.index:
-        emp_id = employee_data['工号']
+def watch_folder(folder=None, output_folder=None, interval=None, settle_seconds=None, workers=None,
+                 max_cycles=None, stop_event=None):
+    """监控收件文件夹，文件到达或变化后增量处理并更新合并结果；max_cycles 用于只扫描有限次"""
+    folder = folder or Config.WATCH_FOLDER
+    output_folder = output_folder or Config.OUTPUT_FOLDER
+    interval = Config.WATCH_INTERVAL if interval is None else interval
+    os.makedirs(folder, exist_ok=True)
+
+    watcher = FolderWatcher(folder, settle_seconds)
+    merge = IncrementalMerge()
+    logger.info(f"开始监控文件夹: {os.path.abspath(folder)}（间隔 {interval}秒，稳定 {watcher.settle_seconds}秒后处理）")
+
+    cycle = 0
+    while max_cycles is None or cycle < max_cycles:
+        if cycle:
+            if stop_event is not None:
+                if stop_event.wait(interval):
+                    break
+            else:
+                time.sleep(interval)
+        cycle += 1
+
+        ready, removed = watcher.poll()
+        changed = merge.remove(removed)
+        for path in removed:
+            logger.info(f"文件已删除: {os.path.basename(path)}")
+        if ready:
+            logger.info(f"处理新增或变化的文件: {', '.join(os.path.basename(path) for path in ready)}")
+            start = time.perf_counter()
+            results = ingest_files(ready, workers)
+            for path in ready:
+                # 处理失败的文件也记录状态，等文件再次变化时重试
+                watcher.mark_processed(path)
+            changed = merge.update(results) or changed
+            logger.info(f"处理 {len(ready)} 个文件耗时 {time.perf_counter() - start:.1f}秒")
+        if not changed:
+            continue
 
-        if pd.isna(emp_id) or str(emp_id).strip() == '':
+        merged_df = merge.merged()
+        if merged_df is None:
+            logger.warning("收件文件夹中暂无可用数据")
+            continue
+        start = time.perf_counter()
+        output_path = save_watch_output(merged_df, output_folder)
+        if output_path:
+            logger.info(f"合并结果已更新: {output_path}（{len(merge.frames)}个文件，{len(merged_df)}条记录，"
+                        f"写出耗时 {time.perf_counter() - start:.1f}秒）")
+    return merge
+
+
+# ===================== 工资条生成 =====================
+class PayslipTemplate:
+    """工资条模板：列顺序、表头样式、数字格式和列宽每次运行只计算一次"""
+    IMPORTANT_COLS = ['姓名', '工号', '部门', '实发工资', '基本工资', '绩效工资', '奖金', '扣款']
+    EXCLUDED_COLS = ['数据来源', 'employee_id']
+    # 快速生成自检结果按列名缓存，每个进程每种表头只检查一次
+    _fast_path_checks = {}
+
+    def __init__(self, columns, pay_month=None):
+        columns = [col for col in columns if col not in self.EXCLUDED_COLS]
+        important_cols = [col for col in self.IMPORTANT_COLS if col in columns]
+        other_cols = [col for col in columns if col not in important_cols]
+        self.columns = important_cols + other_cols
+        self.number_cols = {
+            col_idx for col_idx, col_name in enumerate(self.columns)
+            if any(keyword in col_name for keyword in Config.SALARY_KEYWORDS)
+        }
+        self.column_letters = [
+            openpyxl.utils.get_column_letter(col_idx) for col_idx in range(1, len(self.columns) + 1)
+        ]
+        self.header_font = openpyxl.styles.Font(bold=True)
+        self.pay_month = pay_month or datetime.now().strftime('%Y%m')
+        self._skeleton = None
+        self.fast_path = True
+
+    def row_values(self, employee_data):
+        """按模板列顺序取出一名员工的数据"""
+        return [employee_data[col] if col in employee_data.index else None for col in self.columns]
+
+    def filename(self, employee_data):
+        """工资条附件文件名（修复工号不存在的问题）"""
+        emp_name = employee_data.get('姓名', '未知')
+
+        if '工号' in employee_data.index:
+            emp_id = employee_data['工号']
+
+            if pd.isna(emp_id) or str(emp_id).strip() == '':
+                emp_id = str(employee_data.name)
+        else:
             emp_id = str(employee_data.name)
-    else:
-        emp_id = str(employee_data.name)
 
+        emp_id_str = str(emp_id).replace('/', '').replace('\\', '')
+        return f"{self.pay_month}工资条_{emp_name}_{emp_id_str}.xlsx"
 
-    emp_id_str = str(emp_id).replace('/', '').replace('\\', '')
-    filename = f"{datetime.now().strftime('%Y%m')}工资条_{emp_name}_{emp_id_str}.xlsx"
-    file_path = os.path.join(temp_dir, filename)
+    def filenames(self, df):
+        """生成所有员工的附件文件名，规则与 filename 相同：逐个取值转字符串
+        （按列 map(str) 会把含缺失值的可空整数工号写成 1001.0），工号缺失或为空时使用行号"""
+        names = [str(name) for name in df['姓名']] if '姓名' in df.columns else ['未知'] * len(df)
+        if '工号' in df.columns:
+            emp_ids = [str(index) if pd.isna(emp_id) or str(emp_id).strip() == '' else str(emp_id)
+                       for index, emp_id in zip(df.index, df['工号'])]
+        else:
+            emp_ids = [str(index) for index in df.index]
+        return pd.Series(
+            [f"{self.pay_month}工资条_{name}_{emp_id.replace('/', '').replace(chr(92), '')}.xlsx"
+             for name, emp_id in zip(names, emp_ids)],
+            index=df.index, dtype=object
+        )
 
+    def render(self, values):
+        """将一名员工的数据渲染为xlsx文件内容（bytes），不经过磁盘"""
+        if self._skeleton is None:
+            self._skeleton = self._build_skeleton()
+        row_xml = self._row_xml(values) if self.fast_path else None
+        if row_xml is None:
+            # 带时区的时间等无法直接写入的类型交给 openpyxl 处理
+            return self._render_workbook(values)
+        return self._render_fast(self._skeleton, row_xml)
+
+    def _render_fast(self, skeleton, row_xml):
+        """把数据行 XML 填入骨架，其余文件原样写回"""
+        members, sheet_name, sheet_head, sheet_tail = skeleton
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, data in members:
+                if name == sheet_name:
+                    data = sheet_head + row_xml.encode('utf-8') + sheet_tail
+                zf.writestr(name, data)
+        return buffer.getvalue()
+
+    def _build_skeleton(self):
+        """用 openpyxl 生成一次只有表头的工资条，之后每名员工只替换数据行"""
+        rows = [[None] * len(self.columns)]
+        # 再写两行日期、日期时间样例，让样式表中包含日期格式，之后取出它们的样式编号
+        probe_idx = next((idx for idx in range(len(self.columns)) if idx not in self.number_cols), None)
+        if probe_idx is not None:
+            for sample in (date(2000, 1, 1), datetime(2000, 1, 1)):
+                row = [None] * len(self.columns)
+                row[probe_idx] = sample
+                rows.append(row)
+        content = self._render_workbook(*rows)
+        with zipfile.ZipFile(io.BytesIO(content)) as zf:
+            members = [(info.filename, zf.read(info.filename)) for info in zf.infolist()]
+        sheet_name, sheet_xml = next((name, data) for name, data in members
+                                     if name.startswith('xl/worksheets/'))
+        row_start = sheet_xml.index(b'<row r="2">')
+        row_end = sheet_xml.index(b'</sheetData>', row_start)
+        rows_xml = sheet_xml[row_start:row_end]
+        style = re.search(rb' s="(\d+)"', rows_xml[:rows_xml.index(b'</row>')])
+        self.number_style = f' s="{style.group(1).decode()}"' if style else ''
+        self.date_styles = {}
+        if probe_idx is not None:
+            letter = self.column_letters[probe_idx]
+            for kind, row_num in ((date, 3), (datetime, 4)):
+                style = re.search(f'<c r="{letter}{row_num}" s="(\\d+)"'.encode(), rows_xml)
+                if style:
+                    self.date_styles[kind] = f' s="{style.group(1).decode()}"'
+        skeleton = members, sheet_name, sheet_xml[:row_start], sheet_xml[row_end:]
+
+        key = tuple(self.columns)
+        if key not in self._fast_path_checks:
+            self._fast_path_checks[key] = self._check_fast_path(skeleton)
+        self.fast_path = self._fast_path_checks[key]
+        return skeleton
+
+    def _check_fast_path(self, skeleton):
+        """自检：同一组样例行分别用骨架和 openpyxl 渲染，单元格取值或格式不一致时本模板只用 openpyxl"""
+        samples = self._sample_rows()
+        try:
+            rows_xml = ''.join(self._row_xml(row, row_num) for row_num, row in enumerate(samples, 2))
+            matched = (self._cells(self._render_fast(skeleton, rows_xml))
+                       == self._cells(self._render_workbook(*samples)))
+        except Exception as e:
+            logger.warning(f"工资条快速生成自检出错: {str(e)}")
+            matched = False
+        if not matched:
+            logger.warning("工资条快速生成与 openpyxl 结果不一致，改用 openpyxl 逐份生成")
+        return matched
+
+    def _sample_rows(self):
+        """自检用的样例行：快速路径支持的每种取值至少出现在一个非数字列中"""
+        texts = ['张三 <A&B> ', 12345, date(2024, 1, 31), datetime(2024, 1, 31, 8, 30, 15), True, None, -0.125]
+        numbers = [1234567.891, None, 12345, -0.125]
+        text_cols = [idx for idx in range(len(self.columns)) if idx not in self.number_cols]
+        count = max(len(numbers), -(-len(texts) // len(text_cols)) if text_cols else 0)
+        rows = []
+        for row_idx in range(count):
+            row = [None] * len(self.columns)
+            for pos, col_idx in enumerate(text_cols):
+                row[col_idx] = texts[(row_idx * len(text_cols) + pos) % len(texts)]
+            for pos, col_idx in enumerate(sorted(self.number_cols)):
+                row[col_idx] = numbers[(row_idx + pos) % len(numbers)]
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _cells(content):
+        """读出工资条中每个单元格的取值、类型和数字格式（样式编号因写入顺序不同，不直接比较 XML）"""
+        wb = openpyxl.load_workbook(io.BytesIO(content))
+        try:
+            return [[(cell.value, cell.data_type, cell.number_format) for cell in row]
+                    for row in wb.active.iter_rows()]
+        finally:
+            wb.close()
+
+    def _row_xml(self, values, row_num=2):
+        """生成数据行的 XML，遇到字符串、数字、布尔、日期以外的值时返回 None"""
+        cells = []
+        for col_idx, value in enumerate(values):
+            ref = f'{self.column_letters[col_idx]}{row_num}'
+            style = self.number_style if col_idx in self.number_cols else ''
+            if value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+                if style:
+                    cells.append(f'<c r="{ref}"{style} t="n" />')
+            elif isinstance(value, bool):
+                cells.append(f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, (int, float, np.integer, np.floating)):
+                if not np.isfinite(value):
+                    return None
+                cells.append(f'<c r="{ref}"{style} t="n"><v>{value.item() if isinstance(value, np.generic) else value}</v></c>')
+            elif isinstance(value, date):
+                # 与 openpyxl 相同：日期写成 Excel 序列号，数字列沿用数字格式
+                style = style or self.date_styles.get(datetime if isinstance(value, datetime) else date)
+                if not style or getattr(value, 'tzinfo', None) is not None:
+                    return None
+                serial = openpyxl.utils.datetime.to_excel(value)
+                cells.append(f'<c r="{ref}"{style} t="n"><v>{"%.16g" % serial}</v></c>')
+            elif isinstance(value, str):
+                if openpyxl.cell.cell.ILLEGAL_CHARACTERS_RE.search(value):
+                    return None
+                space = ' xml:space="preserve"' if value != value.strip() else ''
+                cells.append(f'<c r="{ref}"{style} t="inlineStr"><is><t{space}>{html.escape(value, quote=False)}</t></is></c>')
+            else:
+                return None
+        return f'<row r="{row_num}">' + ''.join(cells) + '</row>'
+
+    def _render_workbook(self, *rows):
+        """用 openpyxl 渲染一份完整的工资条，每个参数是一行数据"""
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("工资明细")
+        for letter in self.column_letters:
+            ws.column_dimensions[letter].width = 15
+
+        header = []
+        for col_name in self.columns:
+            cell = openpyxl.cell.WriteOnlyCell(ws, value=col_name)
+            cell.font = self.header_font
+            header.append(cell)
+        ws.append(header)
+
+        for values in rows:
+            row = []
+            for col_idx, value in enumerate(values):
+                # 可空类型的缺失值（pd.NA）不能直接写入单元格
+                value = None if pd.isna(value) else value
+                if col_idx in self.number_cols:
+                    value = openpyxl.cell.WriteOnlyCell(ws, value=value)
+                    value.number_format = '#,##0.00'
+                row.append(value)
+            ws.append(row)
+
+        buffer = io.BytesIO()
+        wb.save(buffer)
+        return buffer.getvalue()
+
+
+def employee_ids(df):
+    """员工标识：优先使用工号，没有工号列时使用 姓名_行号"""
+    if '工号' in df.columns:
+        return df['工号']
+    return df['姓名'].astype(str) + '_' + df.index.astype(str)
+
+
+# 工号缺失时发送记录中使用的标识（与此前 str(pd.NA) 写入的记录一致）
+MISSING_EMPLOYEE_ID = '<NA>'
+
+
+def ledger_employee_id(employee_id):
+    """发送记录中的员工标识：统一转为字符串，缺失值（None/NaN/NA）使用固定标记"""
+    if employee_id is None or (pd.api.types.is_scalar(employee_id) and pd.isna(employee_id)):
+        return MISSING_EMPLOYEE_ID
+    return str(employee_id)
+
+
+def render_payslip_chunk(chunk, ids, pay_month=None):
+    """渲染一批员工的工资条（可在子进程中运行），返回 [(员工标识, bytes或None, 错误)]"""
+    template = PayslipTemplate(chunk.columns, pay_month)
+    rows = chunk.reindex(columns=template.columns).itertuples(index=False, name=None)
+    results = []
+    for employee_id, values in zip(ids, rows):
+        try:
+            results.append((employee_id, template.render(values), None))
+        except Exception as e:
+            results.append((employee_id, None, str(e)))
+    return results
+
+
+def iter_payslip_chunks(df, workers=None, chunk_rows=None, pay_month=None, ids=None):
+    """按顺序分块生成工资条，逐块返回 (chunk, [(员工标识, bytes或None, 错误)])；
+    workers>1 时使用进程池，同时在途的块数有上限，内存占用与表格大小无关"""
+    if workers is None:
+        workers = Config.RENDER_WORKERS
+    chunk_rows = chunk_rows or Config.RENDER_CHUNK_ROWS
+    pay_month = pay_month or datetime.now().strftime('%Y%m')
+    ids = list(employee_ids(df) if ids is None else ids)
+    starts = range(0, len(df), chunk_rows)
+    workers = max(1, min(workers, len(starts)))
+
+    if workers == 1:
+        for start in starts:
+            chunk = df.iloc[start:start + chunk_rows]
+            yield chunk, render_payslip_chunk(chunk, ids[start:start + chunk_rows], pay_month)
+        return
+
+    logger.info(f"使用 {workers} 个进程并行生成 {len(df)} 份工资条")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = []
+        for start in starts:
+            chunk, chunk_ids = df.iloc[start:start + chunk_rows], ids[start:start + chunk_rows]
+            in_flight.append((chunk, chunk_ids, executor.submit(render_payslip_chunk, chunk, chunk_ids, pay_month)))
+            if len(in_flight) >= workers * 2:
+                yield _chunk_result(*in_flight.pop(0))
+        for item in in_flight:
+            yield _chunk_result(*item)
+
+
+def _chunk_result(chunk, chunk_ids, future):
     try:
-
-        from openpyxl import Workbook
-
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "工资明细"
-        ws.sheet_state = "visible"
-
-
-        important_cols = []
-
-        for col in ['姓名', '工号', '部门', '实发工资', '基本工资', '绩效工资', '奖金', '扣款']:
-            if col in employee_data.index:
-                important_cols.append(col)
-
-
-        all_cols = [col for col in employee_data.index if col != '数据来源']
-        other_cols = [col for col in all_cols if col not in important_cols]
-        ordered_cols = important_cols + other_cols
-
-
-        for col_idx, col_name in enumerate(ordered_cols, 1):
-            cell = ws.cell(row=1, column=col_idx)
-            cell.value = col_name
-            cell.font = Font(bold=True)
+        return chunk, future.result()
+    except Exception as e:
+        # 子进程异常退出时整批记为失败
+        return chunk, [(employee_id, None, str(e)) for employee_id in chunk_ids]
 
 
-        for col_idx, col_name in enumerate(ordered_cols, 1):
-            cell = ws.cell(row=2, column=col_idx)
-            cell.value = employee_data[col_name]
+def render_payslips(df, workers=None, progress_callback=None, chunk_rows=None):
+    """批量生成所有员工的工资条，返回 {行索引: xlsx bytes}（工号重复或缺失时也不会互相覆盖），
+    workers>1 时使用进程池"""
+    total = len(df)
+    attachments = {}
+    done = 0
+    start_time = time.perf_counter()
+    for chunk, results in iter_payslip_chunks(df, workers, chunk_rows):
+        for row_index, (employee_id, content, error) in zip(chunk.index, results):
+            if error:
+                logger.error(f"生成工资条失败: {employee_id} - {error}")
+            else:
+                attachments[row_index] = content
+        done += len(results)
+        if progress_callback:
+            progress_callback(done, total, f"已生成工资条 {done}/{total}")
+
+    logger.info(f"工资条生成完成: {len(attachments)}/{total} 份, 耗时 {time.perf_counter() - start_time:.2f}s")
+    return attachments
 
-            if any(keyword in col_name for keyword in ["工资", "奖金", "补贴", "扣款", "社保", "公积金", "个税"]):
-                cell.number_format = '#,##0.00'
 
+def generate_employee_salary_sheet(employee_data, temp_dir=Config.TEMP_SALARY_DIR):
+    """生成单个员工的工资条Excel文件（修复工号不存在的问题）"""
 
-        for col_idx in range(1, len(ordered_cols) + 1):
-            ws.column_dimensions[get_column_letter(col_idx)].width = 15
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
 
+    template = PayslipTemplate(employee_data.index)
+    filename = template.filename(employee_data)
+    file_path = os.path.join(temp_dir, filename)
 
-        wb.save(file_path)
+    try:
+        content = template.render(template.row_values(employee_data))
+        with open(file_path, 'wb') as f:
+            f.write(content)
         logger.info(f"生成工资条文件: {filename}")
         return file_path
 
@@ -434,9 +1488,507 @@ def generate_employee_salary_sheet(employee_data, temp_dir=Config.TEMP_SALARY_DI
         return None
 
 
+# ===================== SMTP连接池 =====================
+class SMTPSession:
+    """保持登录状态的SMTP连接：空闲后先NOOP检查，断线自动重连，发送一定数量后轮换连接"""
+
+    def __init__(self, smtp_config, max_messages=None, noop_after=None):
+        self.smtp_config = smtp_config
+        self.max_messages = max_messages or Config.SMTP_ROTATE_AFTER
+        self.noop_after = Config.SMTP_NOOP_AFTER if noop_after is None else noop_after
+        self.server = None
+        self.sent_on_connection = 0
+        self.last_used = 0.0
+        self.connects = 0
+        self.reconnects = 0
+
+    def connect(self):
+        """建立连接并登录：465端口使用SSL，其他端口在服务器支持时使用STARTTLS"""
+        self.close()
+        host, port = self.smtp_config['server'], int(self.smtp_config['port'])
+        if port == 465:
+            server = smtplib.SMTP_SSL(host, port, timeout=Config.SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(host, port, timeout=Config.SMTP_TIMEOUT)
+            server.ehlo()
+            if server.has_extn('starttls'):
+                server.starttls()
+                server.ehlo()
+        try:
+            server.login(self.smtp_config['email'], self.smtp_config['password'])
+        except Exception:
+            server.close()
+            raise
+
+        self.server = server
+        self.sent_on_connection = 0
+        self.last_used = time.monotonic()
+        self.connects += 1
+        logger.info(f"邮件服务器登录成功: {host}:{port}")
+
+    def ensure_connected(self):
+        """发送前确认连接可用"""
+        if self.server is not None and self.sent_on_connection >= self.max_messages:
+            logger.info(f"连接已发送 {self.sent_on_connection} 封邮件，重新建立连接")
+            self.close()
+
+        if self.server is not None and time.monotonic() - self.last_used > self.noop_after:
+            try:
+                if self.server.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+
+        if self.server is None:
+            self.connect()
+
+    def send(self, msg):
+        """发送一封邮件，连接被服务器断开时重连后重试一次"""
+        self.ensure_connected()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            logger.warning("邮件服务器连接已断开，重新连接后重试")
+            self.reconnects += 1
+            self.connect()
+            self.server.send_message(msg)
+        self.sent_on_connection += 1
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """退出登录并关闭连接"""
+        if self.server is None:
+            return
+        server, self.server = self.server, None
+        try:
+            server.quit()
+        except smtplib.SMTPServerDisconnected:
+            server.close()
+        except Exception as e:
+            logger.warning(f"关闭连接时出错: {str(e)}")
+            server.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SMTPPool:
+    """SMTP连接池：最多 size 个已登录会话，在多封邮件和多个发送线程之间复用"""
+
+    def __init__(self, smtp_config, size=1, **session_options):
+        self.smtp_config = smtp_config
+        self.session_options = session_options
+        self.sessions = []
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def session(self):
+        """借出一个会话，用完后归还（连接保持打开）"""
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                session = self._idle.pop()
+            else:
+                session = SMTPSession(self.smtp_config, **self.session_options)
+                self.sessions.append(session)
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._idle.append(session)
+            self._slots.release()
+
+    def send(self, msg):
+        with self.session() as session:
+            session.send(msg)
+
+    @property
+    def connects(self):
+        return sum(session.connects for session in self.sessions)
+
+    @property
+    def reconnects(self):
+        return sum(session.reconnects for session in self.sessions)
+
+    def close(self):
+        """关闭池中所有连接"""
+        with self._lock:
+            for session in self.sessions:
+                session.close()
+
+
+# ===================== 发送限速 =====================
+class QuotaExceeded(Exception):
+    """已达到服务商的每日发送上限"""
+
+
+class RateLimiter:
+    """令牌桶限速：按每分钟速率补充令牌、限制每日总量，服务器限流时指数退避"""
+
+    def __init__(self, per_minute, per_day=None, burst=1):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.per_day = per_day
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.backoff = 0
+        self.day = datetime.now().date()
+        self.used_today = 0
+        self.throttles = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def for_server(cls, smtp_config, ledger=None):
+        """根据SMTP服务器选择限速档位；传入发送记录时，每日额度扣除今天已发送的数量"""
+        profile = dict(Config.SMTP_RATE_PROFILES.get(str(smtp_config['server']).lower(), Config.SMTP_DEFAULT_RATE))
+        for key in ('per_minute', 'per_day'):
+            if smtp_config.get(key):
+                profile[key] = smtp_config[key]
+        logger.info(f"发送限速: 每分钟 {profile['per_minute']} 封, 每天 {profile['per_day'] or '不限'} 封")
+        limiter = cls(profile['per_minute'], profile['per_day'])
+        if ledger is not None and limiter.per_day:
+            # 额度按天计算，重新运行、续发或发件箱发送都不会重新拿到一整天的额度
+            try:
+                limiter.used_today = ledger.sent_on(limiter.day)
+            except Exception as e:
+                logger.warning(f"读取今日发送数量失败: {str(e)}")
+            logger.info(f"今天已发送 {limiter.used_today} 封，剩余额度 {max(0, limiter.per_day - limiter.used_today)} 封")
+        return limiter
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        today = datetime.now().date()
+        if today != self.day:
+            self.day, self.used_today = today, 0
+
+    def acquire(self, cancel_event=None):
+        """等待并占用一个发送名额，超出每日上限时抛出 QuotaExceeded，等待中被取消时抛出 JobCancelled"""
+        with self._cond:
+            while True:
+                check_cancelled(cancel_event)
+                now = time.monotonic()
+                self._refill(now)
+                if self.per_day and self.used_today >= self.per_day:
+                    raise QuotaExceeded(f"已达到每日发送上限 {self.per_day} 封")
+                wait = self.blocked_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += 1
+                    return
+                if wait <= 0:
+                    wait = (1 - self.tokens) / self.rate
+                # 可取消时分段等待，限流退避期间也能及时响应取消
+                self._cond.wait(wait if cancel_event is None else min(wait, 0.5))
+
+    def refund(self):
+        """邮件未被服务器接收，归还名额"""
+        with self._cond:
+            self.tokens = min(self.capacity, self.tokens + 1)
+            self.used_today = max(0, self.used_today - 1)
+            self._cond.notify()
+
+    def throttled(self):
+        """服务器返回限流回复：暂停发送，连续限流时退避时间加倍"""
+        with self._cond:
+            self.throttles += 1
+            self.backoff = min(Config.SMTP_BACKOFF_MAX, self.backoff * 2 or Config.SMTP_BACKOFF_START)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + self.backoff)
+            return self.backoff
+
+    def succeeded(self):
+        """发送成功后重置退避时间"""
+        with self._cond:
+            self.backoff = 0
+
+
+def smtp_error_code(error):
+    """取出SMTP异常中的服务器回复码"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return codes[0] if codes else None
+    return None
+
+
+def send_with_rate_limit(pool, limiter, msg, cancel_event=None):
+    """在限速器允许时发送，遇到 421/450/451 限流回复时退避后重试，未发出的邮件不占用名额"""
+    for attempt in range(Config.SMTP_THROTTLE_RETRIES + 1):
+        limiter.acquire(cancel_event)
+        try:
+            pool.send(msg)
+        except Exception as e:
+            limiter.refund()
+            if smtp_error_code(e) in Config.SMTP_THROTTLE_CODES and attempt < Config.SMTP_THROTTLE_RETRIES:
+                delay = limiter.throttled()
+                logger.warning(f"服务器限流({smtp_error_code(e)})，{delay} 秒后重试: {msg['To']}")
+                continue
+            raise
+        limiter.succeeded()
+        return
+
+
+# ===================== 发送记录 =====================
+class SendLedger:
+    """工资条发送记录（SQLite WAL），以 发薪月份+员工标识+工资条内容哈希 为键，用于断点续发"""
+
+    def __init__(self, db_file=None):
+        self.conn = sqlite3.connect(db_file or Config.DB_FILE, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS send_ledger (
+                pay_month TEXT NOT NULL,
+                employee_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                employee_name TEXT,
+                email TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                smtp_response TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (pay_month, employee_id, content_hash)
+            )
+        """)
+        self.conn.commit()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def sent_keys(self, pay_month):
+        """本月已成功发送的 (员工标识, 内容哈希)"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT employee_id, content_hash FROM send_ledger WHERE pay_month = ? AND status = 'sent'",
+                (pay_month,)
+            ).fetchall()
+        return set(rows)
+
+    def sent_on(self, day):
+        """某天发送成功的邮件数（按最后更新时间计）"""
+        with self._lock:
+            self._flush()
+            row = self.conn.execute(
+                "SELECT COUNT(*) FROM send_ledger WHERE status = 'sent' AND updated_at >= ? AND updated_at < ?",
+                (day.strftime('%Y-%m-%d'), (day + timedelta(days=1)).strftime('%Y-%m-%d'))
+            ).fetchone()
+        return row[0]
+
+    def record(self, pay_month, employee_id, content_hash, employee_name, email, status, smtp_response=None):
+        """记录一次发送结果（status: sent/failed/skipped），攒批写入"""
+        with self._lock:
+            self._pending.append((
+                pay_month, ledger_employee_id(employee_id), content_hash, str(employee_name), str(email), status,
+                smtp_response, datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            ))
+            if (len(self._pending) >= Config.LEDGER_BATCH_SIZE
+                    or time.monotonic() - self._last_flush >= Config.LEDGER_FLUSH_SECONDS):
+                self._flush()
+
+    def try_record(self, pay_month, employee_id, content_hash, employee_name, email, status, smtp_response=None):
+        """同 record；数据库暂时不可写（如被锁定）时只记录日志，不中断发送流程"""
+        try:
+            self.record(pay_month, employee_id, content_hash, employee_name, email, status, smtp_response)
+        except Exception as e:
+            logger.error(f"写入发送记录失败: {employee_name} - {str(e)}")
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO send_ledger (pay_month, employee_id, content_hash, employee_name, email,
+                                         status, attempts, smtp_response, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (pay_month, employee_id, content_hash) DO UPDATE SET
+                    employee_name = excluded.employee_name,
+                    email = excluded.email,
+                    status = excluded.status,
+                    attempts = send_ledger.attempts + 1,
+                    smtp_response = excluded.smtp_response,
+                    updated_at = excluded.updated_at
+            """, self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def payslip_hashes(df):
+    """每名员工工资条内容的哈希，工资数据变化后视为新的工资条"""
+    columns = PayslipTemplate(df.columns).columns
+    return pd.Series(
+        [hashlib.sha1('\x1f'.join('' if pd.isna(value) else str(value) for value in values).encode('utf-8')).hexdigest()
+         for values in df[columns].itertuples(index=False, name=None)],
+        index=df.index
+    )
+
+
+def filter_unsent(df, pay_month=None, db_file=None):
+    """去掉本月已发送且工资条内容未变化的员工"""
+    pay_month = pay_month or datetime.now().strftime('%Y%m')
+    ledger = SendLedger(db_file)
+    try:
+        sent = ledger.sent_keys(pay_month)
+    finally:
+        ledger.close()
+    if not sent:
+        return df
+    keys = zip(map(ledger_employee_id, employee_ids(df)), payslip_hashes(df))
+    return df[[key not in sent for key in keys]]
+
+
+# ===================== 发送计划 =====================
+class SendRecord:
+    """一名员工的发送计划"""
+    __slots__ = ('index', 'employee_id', 'name', 'email', 'content_hash', 'attachment_name', 'valid', 'duplicate')
+
+    def __init__(self, index, employee_id, name, email, content_hash, attachment_name, valid, duplicate):
+        self.index = index
+        self.employee_id = employee_id
+        self.name = name
+        self.email = email
+        self.content_hash = content_hash
+        self.attachment_name = attachment_name
+        self.valid = valid
+        self.duplicate = duplicate
+
+
+def build_send_plan(df, pay_month=None):
+    """按列一次性算出员工标识、邮箱校验、重复邮箱、附件名和内容哈希，不修改 df"""
+    template = PayslipTemplate(df.columns, pay_month)
+    names = df['姓名'] if '姓名' in df.columns else pd.Series('未知员工', index=df.index)
+    emails = df['邮箱'].astype('string').str.strip()
+    valid = emails.str.fullmatch(Config.EMAIL_PATTERN).fillna(False).astype(bool)
+    duplicate = emails.str.lower().where(valid).duplicated(keep=False) & valid
+
+    plan = [
+        SendRecord(*fields) for fields in zip(
+            df.index, employee_ids(df), names, df['邮箱'].where(~valid, emails), payslip_hashes(df),
+            template.filenames(df), valid, duplicate
+        )
+    ]
+
+    duplicated = [record for record in plan if record.duplicate]
+    if duplicated:
+        examples = ', '.join(f"{record.name}<{record.email}>" for record in duplicated[:5])
+        logger.warning(f"有 {len(duplicated)} 名员工的邮箱与他人重复，将分别发送: {examples}")
+    return plan
+
+
+# ===================== 邮件模板 =====================
+# 可用占位符：${employee_name} ${company_name} ${month} ${hr_contact} ${sender_name} ${sent_at}
+DEFAULT_EMAIL_TEMPLATE = """
+<html>
+<body>
+    <div style="font-family: 'Microsoft YaHei', sans-serif; line-height: 1.6;">
+        <div style="color: #2c3e50; border-bottom: 1px solid #eee; padding-bottom: 10px;">
+            <h2>${company_name}</h2>
+            <h3>${month}工资通知</h3>
+        </div>
+
+        <p>尊敬的${employee_name}：</p>
+        <p>您的${month}工资明细已生成，详情请查看附件中的工资条。</p>
+
+        <p><strong>重要提示：</strong></p>
+        <ul>
+            <li>工资条包含个人隐私信息，请妥善保管并及时查阅</li>
+            <li>如有任何疑问，请联系人力资源部：${hr_contact}</li>
+        </ul>
+
+        <div style="margin-top: 30px; padding-top: 10px; border-top: 1px solid #eee; color: #7f8c8d; font-size: 0.9em;">
+            <p>本邮件为系统自动发送，请勿直接回复</p>
+            <p>${sender_name}</p>
+            <p>${sent_at}</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+
+def load_email_template(path=None):
+    """读取邮件正文模板（HTML），文件不存在时使用内置模板"""
+    path = path or Config.EMAIL_TEMPLATE_FILE
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            logger.info(f"使用邮件模板: {path}")
+            return f.read()
+    return DEFAULT_EMAIL_TEMPLATE
+
+
+class EmailTemplate:
+    """工资条邮件模板：每次发送编译一次，固定内容和邮件头预先生成，每名员工只填入姓名"""
+    ATTACHMENT_SUBTYPE = 'vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def __init__(self, smtp_config, template_text=None, now=None):
+        from email.header import Header
+        from email.utils import formataddr
+
+        now = now or datetime.now()
+        self.month = now.strftime('%Y年%m月')
+        fixed = {
+            'company_name': smtp_config['company_name'],
+            'hr_contact': smtp_config['hr_contact'],
+            'sender_name': smtp_config['sender_name'],
+            'month': self.month,
+            'sent_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        # 固定内容先填入，其中的 $ 转义后不会被当作占位符
+        fixed = {key: html.escape(str(value)).replace('$', '$$') for key, value in fixed.items()}
+        text = load_email_template() if template_text is None else template_text
+        self.body = string.Template(string.Template(text).safe_substitute(fixed))
+        self.from_header = formataddr((str(Header(smtp_config['sender_name'], 'utf-8')), smtp_config['email']))
+        self.subject_prefix = f"{self.month}工资条 - "
+
+    def render_body(self, employee_name):
+        return self.body.safe_substitute(employee_name=html.escape(str(employee_name)))
+
+    def render_text(self, employee_name):
+        """正文的纯文本形式（去掉 HTML 标签和样式），用于界面预览"""
+        body = re.sub(r'<(head|style|script)\b.*?</\1>', '', self.render_body(employee_name),
+                      flags=re.IGNORECASE | re.DOTALL)
+        body = re.sub(r'<li\b[^>]*>', '• ', body, flags=re.IGNORECASE)
+        body = re.sub(r'<br\s*/?>', '\n', body, flags=re.IGNORECASE)
+        lines = (html.unescape(line).strip() for line in re.sub(r'<[^>]+>', '', body).splitlines())
+        return '\n'.join(line for line in lines if line)
+
+    def build(self, employee_name, employee_email, file_data, attachment_name):
+        """组装一封带工资条附件的邮件"""
+        from email.header import Header
+        from email.mime.application import MIMEApplication
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
+        msg = MIMEMultipart()
+        msg['From'] = self.from_header
+        msg['To'] = employee_email
+        msg['Subject'] = Header(self.subject_prefix + str(employee_name), 'utf-8')
+        msg.attach(MIMEText(self.render_body(employee_name), 'html', 'utf-8'))
+
+        attachment = MIMEApplication(file_data, self.ATTACHMENT_SUBTYPE)
+        attachment.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', attachment_name))
+        msg.attach(attachment)
+        return msg
+
+
 # ===================== 邮件发送功能 =====================
-def send_salary_emails(df, smtp_config, progress_callback=None):
-    """发送工资条邮件（含附件）"""
+def send_salary_emails(df, smtp_config, progress_callback=None, stats=None, cancel_event=None):
+    """发送工资条邮件（含附件），stats 为字典时写入各阶段耗时；cancel_event 被设置后停止生成和发送，
+    已发出的邮件照常记录，其余员工未发送"""
     if not all([smtp_config['server'], smtp_config['email'], smtp_config['password']]):
         logger.error("邮件服务器配置不完整")
         return 0, "邮件服务器配置不完整"
@@ -447,156 +1999,561 @@ def send_salary_emails(df, smtp_config, progress_callback=None):
         return 0, "工资表中必须包含'邮箱'列"
 
 
+    in_memory = Config.PAYSLIP_IN_MEMORY
     temp_dir = Config.TEMP_SALARY_DIR
-    if not os.path.exists(temp_dir):
+    if not in_memory and not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
 
 
-    df['employee_id'] = df.apply(
-        lambda row: row['工号'] if '工号' in df.columns else row['姓名'] + '_' + str(row.name),
-        axis=1
-    )
-
+    template = PayslipTemplate(df.columns)
 
     success_count = 0
     total = len(df)
     errors = []
+    done = 0
+    lock = threading.Lock()
+    quota_hit = threading.Event()
+    compose_failed = threading.Event()
+    pay_month = template.pay_month
+    stats = {} if stats is None else stats
+    stats.update({key: 0.0 for key in ('render_seconds', 'render_blocked_seconds', 'compose_seconds',
+                                       'compose_blocked_seconds', 'send_seconds')})
+    stats.update(rendered=0, composed=0)
+
+    def add_time(key, started):
+        with lock:
+            stats[key] += time.perf_counter() - started
+
+    def stopped():
+        """达到每日上限或用户取消后，剩余员工不再发送"""
+        return quota_hit.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    def report(employee_name, status, error_msg=None):
+        """记录一名员工的处理结果并更新进度（各阶段线程共用）"""
+        nonlocal success_count, done
+        with lock:
+            done += 1
+            if status == "已发送":
+                success_count += 1
+            elif error_msg:
+                errors.append(error_msg)
+            if progress_callback:
+                try:
+                    progress_callback(done, total, f"{status}: {employee_name}")
+                except Exception as e:
+                    logger.warning(f"更新进度失败: {str(e)}")
+
+    def record_result(record, status, smtp_response=None):
+        ledger.try_record(pay_month, record.employee_id, record.content_hash, record.name, record.email,
+                          status, smtp_response)
+
+    def rendered_records(sendable):
+        """逐名返回 (发送计划, 附件内容)"""
+        if in_memory:
+            payslip_df = df.loc[[record.index for record in sendable], template.columns]
+            records = iter(sendable)
+            for _, results in iter_payslip_chunks(payslip_df, pay_month=pay_month,
+                                                  ids=[record.employee_id for record in sendable]):
+                for employee_id, content, error in results:
+                    if error:
+                        logger.error(f"生成工资条失败: {employee_id} - {error}")
+                    yield next(records), content
+        else:
+            for record in sendable:
+                attachment_path = generate_employee_salary_sheet(df.loc[record.index], temp_dir)
+                if not attachment_path:
+                    yield record, None
+                    continue
+                with open(attachment_path, 'rb') as f:
+                    yield record, f.read()
+
+    def render_stage(sendable):
+        """生成阶段：分块生成工资条，放入有界队列"""
+        rows = rendered_records(sendable)
+        taken = 0
+        try:
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                started = time.perf_counter()
+                item = next(rows, None)
+                add_time('render_seconds', started)
+                if item is None:
+                    break
+                taken += 1
+                started = time.perf_counter()
+                # 带超时放入队列：组装阶段出错后不会一直阻塞在已满的队列上
+                queued = False
+                while not compose_failed.is_set():
+                    try:
+                        rendered.put(item, timeout=0.5)
+                        queued = True
+                        break
+                    except queue.Full:
+                        continue
+                add_time('render_blocked_seconds', started)
+                if not queued:
+                    for record in sendable[taken - 1:]:
+                        report(record.name, "失败", f"组装邮件阶段出错，{record.name}未发送")
+                    break
+                stats['rendered'] += 1
+        except Exception as e:
+            logger.error(f"生成工资条阶段出错: {str(e)}")
+        finally:
+            rows.close()
+            rendered.put(None)
+
+    def compose_stage():
+        """组装阶段：把工资条组装成邮件，放入发送队列"""
+        record = None
+        try:
+            while True:
+                record = None
+                item = rendered.get()
+                if item is None:
+                    break
+                record, file_data = item
+
+                if stopped():
+                    report(record.name, "未发送")
+                    continue
+
+                if not file_data:
+                    error_msg = f"无法生成{record.name}的工资条"
+                    logger.error(error_msg)
+                    record_result(record, 'failed', error_msg)
+                    report(record.name, "失败", error_msg)
+                    continue
+
+                started = time.perf_counter()
+                try:
+                    msg = email_template.build(record.name, record.email, file_data, record.attachment_name)
+                except Exception as e:
+                    error_msg = f"处理{record.name}时出错: {str(e)}"
+                    logger.error(error_msg)
+                    record_result(record, 'failed', error_msg)
+                    report(record.name, "失败", error_msg)
+                    continue
+                add_time('compose_seconds', started)
+                stats['composed'] += 1
+
+                started = time.perf_counter()
+                tasks.put((record, msg))
+                add_time('compose_blocked_seconds', started)
+        except Exception as e:
+            logger.error(f"组装邮件阶段出错: {str(e)}")
+            compose_failed.set()
+            if record is not None:
+                report(record.name, "失败", f"组装邮件阶段出错，{record.name}未发送")
+            # 继续读取到结束标记，生成阶段才能退出；剩余员工记为失败
+            while True:
+                item = rendered.get()
+                if item is None:
+                    break
+                report(item[0].name, "失败", f"组装邮件阶段出错，{item[0].name}未发送")
+        finally:
+            for _ in range(workers):
+                tasks.put(None)
+
+    def deliver(record, msg):
+        """限速发送一封邮件并记录结果"""
+        employee_name, employee_email = record.name, record.email
+        if stopped():
+            report(employee_name, "未发送")
+            return
+        started = time.perf_counter()
+        try:
+            send_with_rate_limit(pool, limiter, msg, cancel_event)
+        except JobCancelled:
+            report(employee_name, "未发送")
+        except QuotaExceeded as e:
+            quota_hit.set()
+            error_msg = f"{str(e)}，{employee_name}及之后的员工未发送"
+            logger.error(error_msg)
+            report(employee_name, "未发送", error_msg)
+        except Exception as e:
+            error_msg = f"发送给{employee_name}失败: {str(e)}"
+            logger.error(error_msg)
+            record_result(record, 'failed', str(e))
+            report(employee_name, "失败", error_msg)
+        else:
+            logger.info(f"发送成功: {employee_name} <{employee_email}> (含附件)")
+            record_result(record, 'sent', '250')
+            report(employee_name, "已发送")
+        finally:
+            add_time('send_seconds', started)
+
+    def sender():
+        """发送线程：从队列取出邮件直到收到结束标记"""
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            try:
+                deliver(*task)
+            except Exception as e:
+                logger.error(f"发送线程出错: {str(e)}")
+
+    email_template = EmailTemplate(smtp_config)
+    ledger = SendLedger()
+    workers = max(1, int(smtp_config.get('workers') or Config.SMTP_WORKERS))
+    pool = SMTPPool(smtp_config, size=workers)
+    limiter = RateLimiter.for_server(smtp_config, ledger)
+    # 生成、组装、发送三个阶段通过有界队列衔接，内存占用与员工人数无关
+    rendered = queue.Queue(maxsize=Config.PIPELINE_QUEUE_SIZE)
+    tasks = queue.Queue(maxsize=workers * 2)
+    if workers > 1:
+        logger.info(f"使用 {workers} 个发送连接并行发送")
+
+    started = time.perf_counter()
+    try:
+        plan = build_send_plan(df, pay_month)
+        for record in plan:
+            if not record.valid:
+                error_msg = f"跳过无效邮箱: {record.name} - {record.email}"
+                logger.warning(error_msg)
+                record_result(record, 'skipped', error_msg)
+                report(record.name, "跳过", error_msg)
+
+        sendable = [record for record in plan if record.valid]
+        threads = [threading.Thread(target=render_stage, args=(sendable,), daemon=True),
+                   threading.Thread(target=compose_stage, daemon=True)]
+        threads += [threading.Thread(target=sender, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+        try:
+            ledger.close()
+        except Exception as e:
+            logger.error(f"写入发送记录失败: {str(e)}")
 
-    for index, row in df.iterrows():
-        employee_name = row.get('姓名', '未知员工')
-        employee_id = row['employee_id']
-        employee_email = row['邮箱']
-
+    stats['wall_seconds'] = time.perf_counter() - started
+    stats.update(connections=pool.connects, reconnects=pool.reconnects, throttles=limiter.throttles)
+    logger.info(f"阶段耗时: 生成 {stats['render_seconds']:.2f}s (队列等待 {stats['render_blocked_seconds']:.2f}s), "
+                f"组装 {stats['compose_seconds']:.2f}s (队列等待 {stats['compose_blocked_seconds']:.2f}s), "
+                f"发送 {stats['send_seconds']:.2f}s, 总耗时 {stats['wall_seconds']:.2f}s")
 
-        if not isinstance(employee_email, str) or "@" not in employee_email:
-            error_msg = f"跳过无效邮箱: {employee_name} - {employee_email}"
-            logger.warning(error_msg)
-            errors.append(error_msg)
-            if progress_callback:
-                progress_callback(index + 1, total, f"跳过: {employee_name}")
-            continue
 
+    if not in_memory:
         try:
+            shutil.rmtree(temp_dir)
+            logger.info("临时工资条文件已清理")
+        except Exception as e:
+            logger.warning(f"清理临时文件失败: {str(e)}")
 
-            attachment_path = generate_employee_salary_sheet(row, temp_dir)
-            if not attachment_path:
-                error_msg = f"无法生成{employee_name}的工资条"
-                logger.error(error_msg)
-                errors.append(error_msg)
-                continue
+
+    title = "邮件发送已取消" if cancel_event is not None and cancel_event.is_set() else "邮件发送完成"
+    result_msg = f"{title}!\n\n总人数: {total}\n成功: {success_count}\n失败: {total - success_count}"
+    if errors:
+        result_msg += f"\n\n错误详情请查看日志文件"
+        result_msg += f"\n\n部分错误示例:"
+        for error in errors[:5]:
+            result_msg += f"\n- {error}"
+    return success_count, result_msg
 
 
+# ===================== 发件箱 =====================
+def outbox_paths(outbox_dir=None):
+    """发件箱目录：pending/ sent/ failed/ 三个子目录和 index.jsonl 索引"""
+    outbox_dir = outbox_dir or Config.OUTBOX_DIR
+    paths = {name: os.path.join(outbox_dir, name) for name in ('pending', 'sent', 'failed')}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    paths['index'] = os.path.join(outbox_dir, 'index.jsonl')
+    return paths
+
+
+def append_outbox_index(paths, entries):
+    """在索引末尾追加记录（只追加不改写，同时作为发送审计记录）"""
+    if not entries:
+        return
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open(paths['index'], 'a', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(dict(entry, time=now), ensure_ascii=False, default=str) + '\n')
+
+
+def read_outbox_index(paths):
+    """读取索引，返回 {文件名: 合并后的最新状态}"""
+    index = {}
+    if not os.path.exists(paths['index']):
+        return index
+    with open(paths['index'], 'r', encoding='utf-8') as f:
+        for line in f:
             try:
-                server = smtplib.SMTP_SSL(smtp_config['server'], smtp_config['port'])
-                server.login(smtp_config['email'], smtp_config['password'])
-                logger.info(f"邮件服务器登录成功 ({index + 1}/{total})")
-            except Exception as e:
-                logger.error(f"邮件服务器连接失败: {str(e)}")
-                errors.append(f"邮件服务器连接失败: {str(e)}")
-                if progress_callback:
-                    progress_callback(index + 1, total, f"连接失败: {employee_name}")
+                entry = json.loads(line)
+            except ValueError:
+                # 写入中途崩溃留下的半行
                 continue
+            index.setdefault(entry['file'], {}).update(entry)
+    return index
 
 
-            msg = EmailMessage()
-
-
-            email_body = f"""
-            <html>
-            <body>
-                <div style="font-family: 'Microsoft YaHei', sans-serif; line-height: 1.6;">
-                    <div style="color: #2c3e50; border-bottom: 1px solid #eee; padding-bottom: 10px;">
-                        <h2>{smtp_config['company_name']}</h2>
-                        <h3>{datetime.now().strftime('%Y年%m月')}工资通知</h3>
-                    </div>
-
-                    <p>尊敬的{employee_name}：</p>
-                    <p>您的{datetime.now().strftime('%Y年%m月')}工资明细已生成，详情请查看附件中的工资条。</p>
-
-                    <p><strong>重要提示：</strong></p>
-                    <ul>
-                        <li>工资条包含个人隐私信息，请妥善保管并及时查阅</li>
-                        <li>如有任何疑问，请联系人力资源部：{smtp_config['hr_contact']}</li>
-                    </ul>
-
-                    <div style="margin-top: 30px; padding-top: 10px; border-top: 1px solid #eee; color: #7f8c8d; font-size: 0.9em;">
-                        <p>本邮件为系统自动发送，请勿直接回复</p>
-                        <p>{smtp_config['sender_name']}</p>
-                        <p>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-
-
-            from_header = str(Header(smtp_config['sender_name'], 'utf-8'))
-            msg['From'] = formataddr((from_header, smtp_config['email']))
-            msg['To'] = employee_email
-            msg['Subject'] = f"{datetime.now().strftime('%Y年%m月')}工资条 - {employee_name}"
-            msg.set_content(email_body, subtype='html')
-
-
-            with open(attachment_path, 'rb') as f:
-                file_data = f.read()
-            msg.add_attachment(
-                file_data,
-                maintype='application',
-                subtype='vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                filename=os.path.basename(attachment_path)
-            )
+def spool_salary_emails(df, smtp_config, progress_callback=None, outbox_dir=None, cancel_event=None):
+    """生成所有工资条邮件并写入发件箱 pending/ 目录，不连接邮件服务器；已发送或已在 pending/ 中的邮件跳过
+    （保留其重试次数），取消时已写入的邮件保留"""
+    if '邮箱' not in df.columns:
+        logger.error("工资表中缺少'邮箱'列")
+        return 0, "工资表中必须包含'邮箱'列"
 
+    paths = outbox_paths(outbox_dir)
+    template = PayslipTemplate(df.columns)
+    pay_month = template.pay_month
+    email_template = EmailTemplate(smtp_config)
+    plan = build_send_plan(df, pay_month)
+    total = len(plan)
+    errors = [f"跳过无效邮箱: {record.name} - {record.email}" for record in plan if not record.valid]
+    sendable = [record for record in plan if record.valid]
+    done = total - len(sendable)
+    spooled = already_sent = already_pending = 0
+
+    payslip_df = df.loc[[record.index for record in sendable], template.columns]
+    records = iter(sendable)
+    for _, results in iter_payslip_chunks(payslip_df, pay_month=pay_month,
+                                          ids=[record.employee_id for record in sendable]):
+        entries = []
+        for employee_id, content, error in results:
+            record = next(records)
+            done += 1
+            safe_id = re.sub(r'[^\w.-]', '_', ledger_employee_id(record.employee_id))
+            filename = f"{pay_month}_{safe_id}_{record.content_hash[:12]}.eml"
+            if os.path.exists(os.path.join(paths['sent'], filename)):
+                already_sent += 1
+                continue
+            path = os.path.join(paths['pending'], filename)
+            if os.path.exists(path):
+                # 内容相同的邮件仍在等待发送，不重写，也不重置它的重试次数
+                already_pending += 1
+                continue
+            if error:
+                errors.append(f"无法生成{record.name}的工资条: {error}")
+                continue
 
             try:
-                server.send_message(msg)
-                logger.info(f"发送成功: {employee_name} <{employee_email}> (含附件)")
+                msg = email_template.build(record.name, record.email, content, record.attachment_name)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(msg.as_bytes())
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                errors.append(f"写入{record.name}的邮件失败: {str(e)}")
+                continue
+            spooled += 1
+            entries.append({
+                'file': filename, 'status': 'pending', 'attempts': 0, 'pay_month': pay_month,
+                'employee_id': ledger_employee_id(record.employee_id), 'name': str(record.name), 'email': record.email,
+                'content_hash': record.content_hash, 'attachment': record.attachment_name
+            })
+        append_outbox_index(paths, entries)
+        if progress_callback:
+            progress_callback(done, total, f"已写入发件箱 {spooled} 封")
+        if cancel_event is not None and cancel_event.is_set():
+            break
+
+    for error in errors:
+        logger.warning(error)
+    title = "发件箱写入已取消" if cancel_event is not None and cancel_event.is_set() else "发件箱写入完成"
+    result_msg = (f"{title}!\n\n总人数: {total}\n写入: {spooled}\n此前已发送: {already_sent}\n"
+                  f"已在发件箱: {already_pending}\n未写入: {len(errors)}")
+    logger.info(result_msg.replace('\n\n', ' ').replace('\n', ', '))
+    return spooled, result_msg
+
+
+def drain_outbox(smtp_config, progress_callback=None, outbox_dir=None, cancel_event=None):
+    """发送发件箱 pending/ 中的邮件：成功移入 sent/，永久失败或超过重试次数移入 failed/，其余留待下次；
+    取消后剩余邮件留在发件箱"""
+    paths = outbox_paths(outbox_dir)
+    index = read_outbox_index(paths)
+    files = sorted(name for name in os.listdir(paths['pending']) if name.endswith('.eml'))
+    total = len(files)
+    success_count = 0
+    errors = []
+    sent_keys = {}
+
+    pool = SMTPPool(smtp_config)
+    ledger = SendLedger()
+    limiter = RateLimiter.for_server(smtp_config, ledger)
+    try:
+        for position, filename in enumerate(files, 1):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            path = os.path.join(paths['pending'], filename)
+            meta = index.get(filename, {'file': filename, 'attempts': 0})
+            pay_month = meta.get('pay_month')
+            if pay_month not in sent_keys:
+                sent_keys[pay_month] = ledger.sent_keys(pay_month)
+
+            # 上次发送成功但未来得及移动文件（程序中断），不再重复发送
+            if (meta.get('employee_id'), meta.get('content_hash')) in sent_keys[pay_month]:
+                os.replace(path, os.path.join(paths['sent'], filename))
+                append_outbox_index(paths, [{'file': filename, 'status': 'sent', 'response': '发送记录中已存在'}])
                 success_count += 1
-                if progress_callback:
-                    progress_callback(index + 1, total, f"已发送: {employee_name}")
+                continue
+
+            with open(path, 'rb') as f:
+                msg = email.message_from_binary_file(f)
+            attempts = meta.get('attempts', 0) + 1
+            try:
+                send_with_rate_limit(pool, limiter, msg, cancel_event)
+            except JobCancelled:
+                break
+            except QuotaExceeded as e:
+                error_msg = f"{str(e)}，剩余 {total - position + 1} 封留在发件箱"
+                logger.error(error_msg)
+                errors.append(error_msg)
+                break
             except Exception as e:
-                error_msg = f"发送给{employee_name}失败: {str(e)}"
+                code = smtp_error_code(e)
+                permanent = (code is not None and code >= 500) or attempts >= Config.OUTBOX_MAX_ATTEMPTS
+                status = 'failed' if permanent else 'pending'
+                if permanent:
+                    os.replace(path, os.path.join(paths['failed'], filename))
+                error_msg = f"发送给{meta.get('name', filename)}失败（第{attempts}次）: {str(e)}"
                 logger.error(error_msg)
                 errors.append(error_msg)
+                ledger.try_record(pay_month, meta.get('employee_id'), meta.get('content_hash'), meta.get('name'),
+                                  meta.get('email'), 'failed', str(e))
+                append_outbox_index(paths, [{'file': filename, 'status': status, 'attempts': attempts,
+                                             'response': str(e)}])
                 if progress_callback:
-                    progress_callback(index + 1, total, f"失败: {employee_name}")
-            finally:
-
-                try:
-                    server.quit()
-                except Exception as e:
-                    logger.warning(f"关闭连接时出错: {str(e)}")
+                    progress_callback(position, total, f"失败: {meta.get('name', filename)}")
+                continue
 
-        except Exception as e:
-            error_msg = f"处理{employee_name}时出错: {str(e)}"
-            logger.error(error_msg)
-            errors.append(error_msg)
+            # 先移入 sent/：邮件已送达，即使发送记录写入失败也不会在下次重复发送
+            os.replace(path, os.path.join(paths['sent'], filename))
+            ledger.try_record(pay_month, meta.get('employee_id'), meta.get('content_hash'), meta.get('name'),
+                              meta.get('email'), 'sent', '250')
+            append_outbox_index(paths, [{'file': filename, 'status': 'sent', 'attempts': attempts, 'response': '250'}])
+            success_count += 1
+            logger.info(f"发送成功: {meta.get('name', filename)} <{meta.get('email', msg['To'])}>")
             if progress_callback:
-                progress_callback(index + 1, total, f"失败: {employee_name}")
+                progress_callback(position, total, f"已发送: {meta.get('name', filename)}")
+    finally:
+        pool.close()
+        try:
+            ledger.close()
+        except Exception as e:
+            logger.error(f"写入发送记录失败: {str(e)}")
 
+    remaining = len([name for name in os.listdir(paths['pending']) if name.endswith('.eml')])
+    title = "发件箱发送已取消" if cancel_event is not None and cancel_event.is_set() else "发件箱发送完成"
+    result_msg = f"{title}!\n\n待发送: {total}\n成功: {success_count}\n仍在发件箱: {remaining}"
+    if errors:
+        result_msg += f"\n\n部分错误示例:"
+        for error in errors[:5]:
+            result_msg += f"\n- {error}"
+    return success_count, result_msg
 
-        if index < total - 1:
-            delay = 15 if "qq.com" not in smtp_config['server'] else 20
-            logger.info(f"等待 {delay} 秒后发送下一封邮件...")
-            time.sleep(delay)
+
+# ===================== GUI界面 =====================
+def import_gui_modules():
+    """启动图形界面时才导入 tkinter 和 PIL，命令行模式可在没有显示器的服务器上运行"""
+    global tk, filedialog, messagebox, ttk, scrolledtext, askstring
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk, scrolledtext
+    from tkinter.simpledialog import askstring
 
 
+def warm_up_imports():
+    """在后台线程中预先导入 pandas、openpyxl 等依赖，用户第一次处理文件时无需再等待"""
+    start = time.perf_counter()
     try:
-        shutil.rmtree(temp_dir)
-        logger.info("临时工资条文件已清理")
+        for module in (np, pd, openpyxl, smtplib):
+            if isinstance(module, LazyModule):
+                module._load()
+        importlib.import_module('email.mime.multipart')
+        importlib.import_module('email.mime.application')
+        logger.info(f"后台加载依赖完成，耗时 {time.perf_counter() - start:.1f}秒")
     except Exception as e:
-        logger.warning(f"清理临时文件失败: {str(e)}")
+        logger.warning(f"后台加载依赖失败: {str(e)}")
 
 
-    result_msg = f"邮件发送完成!\n\n总人数: {total}\n成功: {success_count}\n失败: {total - success_count}"
-    if errors:
-        result_msg += f"\n\n错误详情请查看日志文件"
-        result_msg += f"\n\n部分错误示例:"
-        for error in errors[:5]:
-            result_msg += f"\n- {error}"
-    return success_count, result_msg
+class JobRunner:
+    """后台任务：同一时间只运行一个任务；工作线程把界面更新放入线程安全队列，由 Tk 主循环用 after() 分批执行"""
+    POLL_MS = 100
+    MAX_EVENTS_PER_POLL = 500
+
+    def __init__(self, root):
+        self.root = root
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.stopping = False
+        self.root.after(self.POLL_MS, self._drain)
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, target, *args, on_done=None, on_cancel=None, on_error=None):
+        """在后台线程中执行 target(cancel_event, *args)，结束后在主线程调用对应的回调"""
+        cancel_event = self.cancel_event = threading.Event()
+
+        def run():
+            try:
+                result = target(cancel_event, *args)
+            except JobCancelled:
+                logger.info("任务已取消")
+                self.post(on_cancel)
+            except Exception as e:
+                logger.exception("后台任务出错")
+                self.post(on_error, e)
+            else:
+                self.post(on_done, result)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        """请求取消当前任务，任务在下一个检查点停止"""
+        self.cancel_event.set()
+
+    def stop(self, on_stopped, timeout=None):
+        """取消当前任务，等工作线程退出（如发送任务写完发送记录、关闭连接）后在主线程调用 on_stopped；
+        等待期间不再执行任务回调，超过 timeout 秒仍未退出时不再等待"""
+        self.cancel()
+        self.stopping = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def wait():
+            if self.busy() and (deadline is None or time.monotonic() < deadline):
+                self.root.after(self.POLL_MS, wait)
+                return
+            if self.busy():
+                logger.warning("后台任务未在限定时间内结束，强制退出")
+            on_stopped()
+
+        wait()
+
+    def post(self, func, *args, latest_only=False):
+        """从任意线程投递一次界面更新；latest_only 的更新（如进度条）在同一批中只执行最后一次"""
+        if func is not None:
+            self.events.put((func, args, latest_only))
+
+    def _drain(self):
+        """在主线程中执行一批界面更新"""
+        batch = []
+        try:
+            while len(batch) < self.MAX_EVENTS_PER_POLL:
+                batch.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+
+        if self.stopping:
+            # 正在退出：任务的完成、取消回调会弹出对话框，不再执行
+            batch = []
+        last = {func: position for position, (func, _, latest_only) in enumerate(batch) if latest_only}
+        for position, (func, args, latest_only) in enumerate(batch):
+            if latest_only and last[func] != position:
+                continue
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("界面更新失败")
+        self.root.after(self.POLL_MS, self._drain)
 
 
-# ===================== GUI界面 =====================
 class SalaryProcessorApp:
     def __init__(self, root):
         self.root = root
@@ -616,12 +2573,16 @@ class SalaryProcessorApp:
 
         self.merged_df = None
         self.output_path = None
+        self.jobs = JobRunner(root)
+        root.protocol("WM_DELETE_WINDOW", self.on_close)
 
-        self.load_logo()
+        # 窗口先显示出来，再加载 PIL 绘制 LOGO
+        self.root.after_idle(self.load_logo)
 
     def load_logo(self):
         """加载公司LOGO（占位）"""
         try:
+            from PIL import Image, ImageTk, ImageDraw
 
             img = Image.new('RGB', (200, 50), color=(73, 109, 137))
             d = ImageDraw.Draw(img)
@@ -715,13 +2676,22 @@ class SalaryProcessorApp:
 
         action_frame = ttk.Frame(tab)
         action_frame.pack(fill="x", padx=10, pady=10)
+        action_buttons = ttk.Frame(action_frame)
+        action_buttons.pack()
         self.process_btn = ttk.Button(
-            action_frame,
+            action_buttons,
             text="处理并合并工资表",
             command=self.process_files,
             style="Accent.TButton"
         )
-        self.process_btn.pack(pady=5)
+        self.process_btn.pack(side="left", padx=5, pady=5)
+        self.cancel_process_btn = ttk.Button(
+            action_buttons,
+            text="取消",
+            command=self.cancel_job,
+            state="disabled"
+        )
+        self.cancel_process_btn.pack(side="left", padx=5, pady=5)
 
         result_frame = ttk.LabelFrame(tab, text="处理结果")
         result_frame.pack(fill="both", expand=True, padx=10, pady=5)
@@ -768,6 +2738,13 @@ class SalaryProcessorApp:
             state="disabled"
         )
         self.send_btn.grid(row=0, column=3, padx=10)
+        self.cancel_send_btn = ttk.Button(
+            control_frame,
+            text="停止发送",
+            command=self.cancel_job,
+            state="disabled"
+        )
+        self.cancel_send_btn.grid(row=0, column=4, padx=5)
 
         progress_frame = ttk.LabelFrame(tab, text="发送进度")
         progress_frame.pack(fill="both", expand=True, padx=10, pady=5)
@@ -933,29 +2910,99 @@ class SalaryProcessorApp:
         self.log(f"移除 {len(selected)} 个文件")
 
     def log(self, message):
-        """记录日志到文本框"""
+        """记录日志到文本框（只在主线程调用，后台任务通过 self.jobs.post 投递）"""
         self.result_text.config(state="normal")
         self.result_text.insert(tk.END, f"{datetime.now().strftime('%H:%M:%S')} - {message}\n")
         self.result_text.see(tk.END)
         self.result_text.config(state="disabled")
         self.status_var.set(message)
-        self.root.update_idletasks()
+
+    def set_busy(self, busy):
+        """后台任务运行期间禁用处理、发送按钮，启用取消按钮"""
+        self.process_btn.config(state="disabled" if busy else "normal")
+        can_send = not busy and self.merged_df is not None and self.output_path
+        self.send_btn.config(state="normal" if can_send else "disabled")
+        self.cancel_process_btn.config(state="normal" if busy else "disabled")
+        self.cancel_send_btn.config(state="normal" if busy else "disabled")
+
+    def start_job(self, target, *args, on_done=None, on_cancel=None):
+        """启动后台任务，已有任务在运行时提示用户"""
+        if self.jobs.busy():
+            messagebox.showwarning("警告", "已有任务在运行，请等待完成或先取消")
+            return
+        self.set_busy(True)
+        self.jobs.start(target, *args, on_done=on_done, on_cancel=on_cancel, on_error=self._on_job_failed)
+
+    def cancel_job(self):
+        """取消当前后台任务"""
+        if self.jobs.busy():
+            self.jobs.cancel()
+            self.status_var.set("正在取消...")
+
+    def _on_job_failed(self, error):
+        self.set_busy(False)
+        self.log(f"任务出错: {str(error)}")
+        messagebox.showerror("错误", f"任务出错: {str(error)}")
+
+    def on_close(self):
+        """关闭窗口：有任务在运行时先确认并取消，等任务退出（发送记录已写入）后再关闭"""
+        if self.jobs.stopping:
+            return
+        if self.jobs.busy():
+            if not messagebox.askyesno("确认退出", "仍有任务在运行，确定要取消并退出吗？"):
+                return
+            self.cancel_process_btn.config(state="disabled")
+            self.cancel_send_btn.config(state="disabled")
+            self.status_var.set("正在停止任务，完成后自动退出...")
+            self.jobs.stop(self.root.destroy, timeout=Config.CLOSE_WAIT_SECONDS)
+            return
+        self.root.destroy()
 
     def process_files(self):
-        """处理文件"""
-        file_paths = self.file_listbox.get(0, tk.END)
+        """处理文件：读取、合并和保存在后台线程中运行，界面保持响应"""
+        file_paths = list(self.file_listbox.get(0, tk.END))
         if not file_paths:
             messagebox.showwarning("警告", "请先添加工资表文件")
             return
+        if self.jobs.busy():
+            messagebox.showwarning("警告", "已有任务在运行，请等待完成或先取消")
+            return
 
         self.result_text.config(state="normal")
         self.result_text.delete(1.0, tk.END)
         self.result_text.config(state="disabled")
 
         self.log("开始处理工资表...")
-        self.merged_df = merge_all_files(file_paths)
+        self.start_job(self._process_files_job, file_paths, on_done=self._on_files_processed,
+                       on_cancel=self._on_process_cancelled)
+
+    def _process_files_job(self, cancel_event, file_paths):
+        """后台线程：读取合并并保存，界面更新交给主线程"""
+        report = []
+        merged_df = merge_all_files(file_paths, workers=Config.MERGE_WORKERS, report=report,
+                                    cancel_event=cancel_event)
+        for item in report:
+            if item['error']:
+                self.jobs.post(self.log, f"文件处理失败: {os.path.basename(item['file'])} - {item['error']}")
+        slowest = max(report, key=lambda item: item['seconds'], default=None)
+        if slowest:
+            self.jobs.post(self.log, f"最慢文件: {os.path.basename(slowest['file'])} ({slowest['seconds']:.1f}秒)")
+        if merged_df is None:
+            return None, None
+        self.jobs.post(self.log, f"合并完成，共 {len(merged_df)} 条记录，正在保存...")
+        return merged_df, save_merged_data(merged_df, Config.OUTPUT_FOLDER, cancel_event=cancel_event)
+
+    def _on_process_cancelled(self):
+        self.set_busy(False)
+        self.log("处理已取消")
+
+    def _on_files_processed(self, result):
+        """处理完成后在主线程中更新界面"""
+        self.merged_df, output_path = result
+        if self.merged_df is not None:
+            self.output_path = output_path
+        self.set_busy(False)
         if self.merged_df is not None:
-            self.output_path = save_merged_data(self.merged_df, Config.OUTPUT_FOLDER)
             if self.output_path:
                 self.log(f"处理完成! 结果已保存至:\n{self.output_path}")
 
@@ -972,9 +3019,7 @@ class SalaryProcessorApp:
                 self.result_text.insert(tk.END, summary)
                 self.result_text.config(state="disabled")
 
-                self.send_btn.config(state="normal")
-
-                os.startfile(Config.OUTPUT_FOLDER)
+                open_folder(Config.OUTPUT_FOLDER)
         else:
             self.log("处理失败，请检查日志")
             messagebox.showerror("错误", "工资表处理失败，请检查日志文件")
@@ -997,13 +3042,20 @@ class SalaryProcessorApp:
         if not all([config['server'], config['email'], config['password']]):
             messagebox.showwarning("警告", "请填写完整的邮件服务器配置")
             return
-        try:
-            server = smtplib.SMTP_SSL(config['server'], config['port'])
-            server.login(config['email'], config['password'])
-            server.quit()
-            messagebox.showinfo("成功", "邮件服务器连接成功!")
-        except Exception as e:
-            messagebox.showerror("错误", f"连接失败: {str(e)}")
+        if self.jobs.busy():
+            messagebox.showwarning("警告", "已有任务在运行，请等待完成或先取消")
+            return
+        self.status_var.set("正在连接邮件服务器...")
+        # 连接可能等待到超时，放到后台线程中进行
+        self.jobs.start(
+            self._test_email_job, config,
+            on_done=lambda _: messagebox.showinfo("成功", "邮件服务器连接成功!"),
+            on_error=lambda e: messagebox.showerror("错误", f"连接失败: {str(e)}")
+        )
+
+    def _test_email_job(self, cancel_event, config):
+        with SMTPSession(config) as session:
+            session.connect()
 
     def save_config(self):
         """保存配置"""
@@ -1012,20 +3064,22 @@ class SalaryProcessorApp:
         self.log("系统配置已更新")
 
     def update_progress(self, current, total, message):
-        """更新进度条"""
+        """更新进度条（只在主线程调用）"""
         progress = (current / total) * 100
         self.progress_var.set(progress)
         self.progress_label.config(text=f"{current}/{total} - {message}")
         self.status_var.set(f"正在发送: {message}")
-        self.root.update_idletasks()
+
+    def post_progress(self, current, total, message):
+        """供后台线程使用的进度回调：投递到主线程，同一批只刷新最后一次"""
+        self.jobs.post(self.update_progress, current, total, message, latest_only=True)
 
     def log_email(self, message):
-        """记录邮件日志"""
+        """记录邮件日志（只在主线程调用）"""
         self.email_log.config(state="normal")
         self.email_log.insert(tk.END, f"{datetime.now().strftime('%H:%M:%S')} - {message}\n")
         self.email_log.see(tk.END)
         self.email_log.config(state="disabled")
-        self.root.update_idletasks()
 
     def send_salaries(self):
         """发送工资条"""
@@ -1033,35 +3087,37 @@ class SalaryProcessorApp:
             messagebox.showwarning("警告", "请先处理工资表")
             return
 
-        send_scope = self.send_scope.get()
-
-        if send_scope == "unsent":
-
-            df_to_send = self.merged_df.copy()
-            self.log_email("注意: 未发送员工筛选功能尚未实现，将发送全部员工")
+        if self.send_scope.get() == "unsent":
+            # 比对发送记录需要计算每名员工的内容哈希，人数多时放到后台线程
+            self.status_var.set("正在比对发送记录...")
+            self.start_job(self._filter_unsent_job, self.merged_df, on_done=self._confirm_send,
+                           on_cancel=lambda: self.set_busy(False))
         else:
-            df_to_send = self.merged_df.copy()
+            self._confirm_send(self.merged_df)
+
+    def _filter_unsent_job(self, cancel_event, df):
+        df_to_send = filter_unsent(df)
+        check_cancelled(cancel_event)
+        return df_to_send
+
+    def _confirm_send(self, df_to_send):
+        """预览邮件并确认后开始发送"""
+        self.set_busy(False)
+        if len(df_to_send) < len(self.merged_df):
+            self.log_email(f"已跳过本月已发送的 {len(self.merged_df) - len(df_to_send)} 位员工")
+        if df_to_send.empty:
+            messagebox.showinfo("提示", "本月所有员工的工资条均已发送")
+            return
 
         smtp_config = self.get_smtp_config()
 
-        preview_text = f"""
-        发件人: {smtp_config['sender_name']} <{smtp_config['email']}>
-        主题: {datetime.now().strftime('%Y年%m月')}工资条 - 员工姓名
-        收件人数: {len(df_to_send)}
-        附件: 包含员工个人工资条Excel文件
-
-        邮件内容:
-        尊敬的[员工姓名]：
-
-        您的{datetime.now().strftime('%Y年%m月')}工资明细已生成，详情请查看附件中的工资条。
-
-        重要提示：
-        • 工资条包含个人隐私信息，请妥善保管
-        • 如有任何疑问，请联系人力资源部：{smtp_config['hr_contact']}
-
-        {smtp_config['sender_name']}
-        {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-        """
+        # 预览与实际发送使用同一个邮件模板（含自定义模板文件）
+        template = EmailTemplate(smtp_config)
+        preview_text = (f"发件人: {smtp_config['sender_name']} <{smtp_config['email']}>\n"
+                        f"主题: {template.subject_prefix}[员工姓名]\n"
+                        f"收件人数: {len(df_to_send)}\n"
+                        f"附件: 包含员工个人工资条Excel文件\n\n"
+                        f"邮件内容:\n{template.render_text('[员工姓名]')}\n")
         self.email_preview.config(state="normal")
         self.email_preview.delete(1.0, tk.END)
         self.email_preview.insert(tk.END, preview_text)
@@ -1076,11 +3132,8 @@ class SalaryProcessorApp:
         self.email_log.delete(1.0, tk.END)
         self.email_log.config(state="disabled")
 
-        threading.Thread(
-            target=self._send_salaries_thread,
-            args=(df_to_send, smtp_config),
-            daemon=True
-        ).start()
+        self.start_job(self._send_salaries_job, df_to_send, smtp_config, on_done=self._on_salaries_sent,
+                       on_cancel=lambda: self._on_salaries_sent("发送已取消"))
 
     def on_provider_selected(self, event=None):
         """选择邮箱服务商后自动填入SMTP设置"""
@@ -1153,31 +3206,182 @@ class SalaryProcessorApp:
         else:
             self.provider_box.set("自定义")
 
-    def _send_salaries_thread(self, df, smtp_config):
-        """在后台线程中发送工资条"""
-        try:
+    def _send_salaries_job(self, cancel_event, df, smtp_config):
+        """后台线程：发送工资条，进度和日志交给主线程显示"""
+        if Config.OUTBOX_MODE:
+            _, spool_msg = spool_salary_emails(df, smtp_config, progress_callback=self.post_progress,
+                                               cancel_event=cancel_event)
+            self.jobs.post(self.log_email, spool_msg)
+            check_cancelled(cancel_event)
+            _, result_msg = drain_outbox(smtp_config, progress_callback=self.post_progress,
+                                         cancel_event=cancel_event)
+        else:
+            _, result_msg = send_salary_emails(df, smtp_config, progress_callback=self.post_progress,
+                                               cancel_event=cancel_event)
+        return result_msg
 
-            success_count, result_msg = send_salary_emails(
-                df,
-                smtp_config,
-                progress_callback=self.update_progress
-            )
-
-            self.log_email(result_msg)
-            messagebox.showinfo("发送完成", result_msg)
-        except Exception as e:
-            self.log_email(f"发送过程中发生错误: {str(e)}")
-            messagebox.showerror("错误", f"发送失败: {str(e)}")
+    def _on_salaries_sent(self, result_msg):
+        self.set_busy(False)
+        self.log_email(result_msg)
+        messagebox.showinfo("发送完成", result_msg)
 
 
 # ===================== 主程序 =====================
+def build_arg_parser():
+    """命令行参数：不带子命令时启动图形界面"""
+    parser = argparse.ArgumentParser(description="企业级工资表智能处理与分发系统")
+    subparsers = parser.add_subparsers(dest="command")
+
+    watch = subparsers.add_parser("watch", help="监控收件文件夹，文件到达后增量合并（无需图形界面）")
+    watch.add_argument("--folder", default=Config.WATCH_FOLDER, help="收件文件夹")
+    watch.add_argument("--output", default=Config.OUTPUT_FOLDER, help="合并结果输出文件夹")
+    watch.add_argument("--interval", type=float, default=Config.WATCH_INTERVAL, help="扫描间隔秒数")
+    watch.add_argument("--settle", type=float, default=Config.WATCH_SETTLE_SECONDS,
+                       help="文件保持不变多少秒后处理")
+    watch.add_argument("--workers", type=int, default=Config.MERGE_WORKERS, help="并行处理的进程数")
+
+    batch = subparsers.add_parser("batch", help="命令行批处理：读取、合并、导出，可选发送工资条（无需图形界面）")
+    batch.add_argument("inputs", nargs="+", help="工资表文件或文件夹（文件夹会递归查找）")
+    batch.add_argument("--output", default=Config.OUTPUT_FOLDER, help="合并结果输出文件夹")
+    batch.add_argument("--formats", nargs="+", choices=["xlsx", "csv", "parquet"], default=["xlsx"],
+                       help="导出格式")
+    batch.add_argument("--workers", type=int, default=Config.MERGE_WORKERS, help="读取工资表的进程数")
+    batch.add_argument("--render-workers", type=int, default=Config.RENDER_WORKERS, help="生成工资条的进程数")
+    batch.add_argument("--smtp-workers", type=int, default=Config.SMTP_WORKERS, help="并行发送的连接数")
+    batch.add_argument("--send", action="store_true", help="合并后发送工资条邮件")
+    batch.add_argument("--scope", choices=["unsent", "all"], default="unsent",
+                       help="发送范围：unsent 跳过本月已发送的员工")
+    batch.add_argument("--outbox", action="store_true", default=Config.OUTBOX_MODE,
+                       help="先写入发件箱再发送")
+    batch.add_argument("--dry-run", action="store_true",
+                       help="只读取合并并生成发送计划和工资条，不导出结果、不写入处理缓存、不连接邮件服务器（日志照常记录）")
+    return parser
+
+
+def collect_payroll_files(inputs, exclude_dirs=()):
+    """展开命令行给出的文件和文件夹，返回去重后的工资表文件列表；
+    递归时跳过 exclude_dirs（输出、缓存文件夹），避免把上次的合并结果再读进来"""
+    excluded = {os.path.realpath(folder) for folder in exclude_dirs}
+    file_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(root, d)) not in excluded)
+                for file in sorted(files):
+                    if file.lower().endswith(('.xlsx', '.xls', '.csv')) and not file.startswith('~$'):
+                        file_paths.append(os.path.join(root, file))
+        elif os.path.isfile(item):
+            file_paths.append(item)
+        else:
+            logger.warning(f"文件不存在: {item}")
+    return list(dict.fromkeys(file_paths))
+
+
+def cli_smtp_config(workers=None):
+    """命令行模式的SMTP配置：取自 Config，授权码可用环境变量 SALARY_SMTP_PASSWORD 提供"""
+    smtp_config = {
+        'server': Config.SMTP_SERVER,
+        'port': Config.SMTP_PORT,
+        'email': Config.SENDER_EMAIL,
+        'password': os.environ.get('SALARY_SMTP_PASSWORD', Config.SENDER_PASSWORD),
+        'sender_name': Config.SENDER_NAME,
+        'company_name': Config.COMPANY_NAME,
+        'hr_contact': Config.HR_CONTACT
+    }
+    if workers:
+        smtp_config['workers'] = workers
+    return smtp_config
+
+
+def run_batch(args):
+    """执行命令行批处理，各阶段耗时输出到标准输出；返回进程退出码"""
+    timings = []
+
+    def stage(name, func, *func_args, **func_kwargs):
+        start = time.perf_counter()
+        result = func(*func_args, **func_kwargs)
+        timings.append((name, time.perf_counter() - start))
+        return result
+
+    def print_timings():
+        print("阶段耗时:")
+        for name, seconds in timings:
+            print(f"  {name}: {seconds:.2f}s")
+
+    Config.RENDER_WORKERS = args.render_workers
+    file_paths = collect_payroll_files(args.inputs, [args.output, Config.OUTPUT_FOLDER, Config.CACHE_DIR])
+    if not file_paths:
+        print("没有找到工资表文件", file=sys.stderr)
+        return 2
+
+    report = []
+    merged_df = stage("读取合并", merge_all_files, file_paths, workers=args.workers, report=report,
+                      store_cache=not args.dry_run)
+    failed = [item for item in report if item['error']]
+    cached = sum(1 for item in report if item['cached'])
+    print(f"文件: {len(file_paths)} 个（缓存命中 {cached}，失败 {len(failed)}）")
+    for item in failed:
+        print(f"  处理失败: {item['file']} - {item['error']}", file=sys.stderr)
+    if merged_df is None:
+        print_timings()
+        return 1
+    print(f"合并记录: {len(merged_df)} 条")
+
+    exit_code = 1 if failed else 0
+    if args.dry_run:
+        plan = stage("发送计划", build_send_plan, merged_df) if '邮箱' in merged_df.columns else []
+        valid = sum(1 for record in plan if record.valid)
+        payslips = stage("生成工资条", render_payslips, merged_df)
+        print(f"演练: 可发送 {valid} 封，邮箱无效 {len(plan) - valid} 个，工资条 {len(payslips)} 份（未导出、未写入缓存、未发送）")
+        print_timings()
+        return exit_code
+
+    outputs = stage("导出", export_merged_data, merged_df, args.output, args.formats)
+    for fmt, output_path in outputs.items():
+        print(f"导出 {fmt}: {output_path}")
+    if len(outputs) < len(args.formats):
+        exit_code = 1
+
+    if args.send:
+        df_to_send = filter_unsent(merged_df) if args.scope == "unsent" else merged_df
+        print(f"待发送: {len(df_to_send)} 人（跳过本月已发送 {len(merged_df) - len(df_to_send)} 人）")
+        smtp_config = cli_smtp_config(args.smtp_workers)
+        if not df_to_send.empty:
+            if args.outbox:
+                _, spool_msg = stage("写入发件箱", spool_salary_emails, df_to_send, smtp_config)
+                print(spool_msg)
+                success_count, result_msg = stage("发送", drain_outbox, smtp_config)
+            else:
+                success_count, result_msg = stage("发送", send_salary_emails, df_to_send, smtp_config)
+            print(result_msg)
+            if success_count < len(df_to_send):
+                exit_code = 1
+
+    print_timings()
+    return exit_code
+
+
 if __name__ == "__main__":
 
-    logger = logging.getLogger()
+    multiprocessing.freeze_support()
+    args = build_arg_parser().parse_args()
+    if args.command == "watch":
+        logger = setup_logging()
+        try:
+            watch_folder(args.folder, args.output, args.interval, args.settle, args.workers)
+        except KeyboardInterrupt:
+            logger.info("已停止监控")
+        sys.exit(0)
+    if args.command == "batch":
+        logger = setup_logging()
+        sys.exit(run_batch(args))
+
     try:
+        import_gui_modules()
 
         root = tk.Tk()
         app = SalaryProcessorApp(root)
+        threading.Thread(target=warm_up_imports, daemon=True).start()
 
         if sys.platform.startswith('win'):
             import ctypes
@@ -0,0 +1,708 @@
+"""
+工资表处理系统性能基准测试
+用法：python excel_benchmark.py numbers [--cells 1000000] [--distinct 20000]
+      python excel_benchmark.py dates [--cells 1000000]
+      python excel_benchmark.py mask [--cells 1000000]
+      python excel_benchmark.py merge [--files 40] [--rows 25000]
+      python excel_benchmark.py export [--files 40] [--rows 100000]
+      python excel_benchmark.py ingest [--rows 10000 100000 1000000] [--formats csv xlsx] [--files 4]
+                                       [--max-stream-rss 0]
+      python excel_benchmark.py payslips [--employees 1000 10000 50000] [--workers 4]
+      python excel_benchmark.py smtp [--employees 100 1000 10000] [--workers 1 4] [--latency 0.05]
+                                     [--throttle-every 0] [--disconnect-every 0]
+      python excel_benchmark.py importtime [--runs 5] [--max-ms 200]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+import EXCEL
+
+
+def timed(func, *args, **kwargs):
+    """执行函数并返回 (结果, 耗时秒数)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB），不支持的平台返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def format_mb(value):
+    return "n/a" if value is None else f"{value:.0f}MB"
+
+
+def process_peak_mb():
+    """本进程自启动（exec）以来的峰值常驻内存（MB）；Linux 的 ru_maxrss 会跨 exec 沿用父进程的峰值，
+    因此优先读取 /proc/self/status 的 VmHWM"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def reset_peak_rss():
+    """把本进程的峰值内存重置为当前占用（Linux 写 /proc/self/clear_refs），之后 process_peak_mb 只反映新的峰值；
+    不支持时返回 False，峰值为进程累计值"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def pss_mb(pid="self"):
+    """进程的按比例分摊内存 PSS（MB），共享页按进程数分摊，多个进程相加不会重复计算；不支持时返回 None"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler:
+    """阶段执行期间在后台线程中定期累加本进程与子进程（进程池）的 PSS，记录合计峰值。
+    fork 出的子进程的 ru_maxrss（RUSAGE_CHILDREN）会把父进程当时的内存也算进去，无法反映进程池实际占用"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self.children = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        pids = ["self"] + [process.pid for process in multiprocessing.active_children()]
+        values = [pss_mb(pid) for pid in pids]
+        if values[0] is None:
+            return
+        self.children = self.children or len(pids) > 1
+        total = sum(value for value in values if value is not None)
+        self.peak = total if self.peak is None else max(self.peak, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def _measured_call(func, args):
+    result, seconds = timed(func, *args)
+    rows = result if isinstance(result, int) else len(result)
+    return rows, seconds, process_peak_mb()
+
+
+def run_isolated(func, *args):
+    """在新进程中执行 func，返回 (结果行数, 耗时秒数, 该进程峰值内存MB)，峰值内存不受之前阶段影响"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_measured_call, (func, args))
+
+
+# ===================== 数字解析 =====================
+def make_number_cells(count, distinct=None, seed=0):
+    """生成混合格式的工资数字单元格，distinct 为不同金额的个数（None 表示几乎不重复）"""
+    rng = random.Random(seed)
+    pool = [round(rng.uniform(0, 50000), 2) for _ in range(distinct)] if distinct else None
+    samples = []
+    for _ in range(count):
+        amount = rng.choice(pool) if pool else round(rng.uniform(0, 50000), 2)
+        kind = rng.randrange(8)
+        if kind == 0:
+            samples.append(amount)
+        elif kind == 1:
+            samples.append(f"{amount:,.2f}")
+        elif kind == 2:
+            samples.append(f"{amount:,.2f}".replace(",", "，"))
+        elif kind == 3:
+            samples.append(f"{amount / 10000:.2f}万")
+        elif kind == 4:
+            samples.append(f"{rng.uniform(0, 100):.1f}%")
+        elif kind == 5:
+            samples.append(f"{amount:,.0f}".replace(",", " "))
+        elif kind == 6:
+            samples.append(None)
+        else:
+            samples.append("待定")
+    return pd.Series(samples, dtype=object)
+
+
+def bench_numbers(args):
+    """对比逐单元格 convert_to_number 与列式 convert_number_column"""
+    for distinct in (args.distinct, None):
+        series = make_number_cells(args.cells, distinct)
+        label = f"{distinct:,} 种金额" if distinct else "金额几乎不重复"
+        print(f"数字解析基准: {len(series):,} 个单元格（{label}）")
+
+        legacy, legacy_time = timed(series.apply, EXCEL.convert_to_number)
+        columnar, columnar_time = timed(EXCEL.convert_number_column, series)
+
+        print(f"  逐单元格 apply : {legacy_time:8.3f}s")
+        print(f"  列式解析       : {columnar_time:8.3f}s")
+        print(f"  加速比         : {legacy_time / columnar_time:8.1f}x")
+
+        mismatched = ~np.isclose(legacy.to_numpy(), columnar.to_numpy())
+        print(f"  结果不一致     : {int(mismatched.sum())}")
+
+
+# ===================== 日期解析 =====================
+def make_date_cells(count, seed=0):
+    """生成考勤表风格的日期单元格（大部分为同一格式，夹杂少量其他写法）"""
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        year, month, day = rng.randint(2020, 2025), rng.randint(1, 12), rng.randint(1, 28)
+        kind = rng.randrange(20)
+        if kind == 0:
+            samples.append(f"{year}-{month:02d}-{day:02d}")
+        elif kind == 1:
+            samples.append(None)
+        else:
+            samples.append(f"{year}年{month}月{day}日")
+    return pd.Series(samples, dtype=object, name="考勤日期")
+
+
+def bench_dates(args):
+    """对比逐单元格 convert_to_date 与列式 convert_date_column"""
+    series = make_date_cells(args.cells)
+    print(f"日期解析基准: {len(series):,} 个单元格")
+
+    legacy, legacy_time = timed(series.apply, EXCEL.convert_to_date)
+    EXCEL.DATE_FORMAT_CACHE.clear()
+    columnar, columnar_time = timed(EXCEL.convert_date_column, series)
+    _, cached_time = timed(EXCEL.convert_date_column, series)
+
+    print(f"  逐单元格 apply     : {legacy_time:8.3f}s")
+    print(f"  列式解析（推断格式）: {columnar_time:8.3f}s")
+    print(f"  列式解析（复用格式）: {cached_time:8.3f}s")
+    mismatched = sum(a != b for a, b in zip(legacy, columnar))
+    print(f"  结果不一致         : {mismatched}")
+
+
+# ===================== 敏感信息脱敏 =====================
+def make_sensitive_cells(count, seed=0):
+    """生成身份证号、银行卡号混合的单元格"""
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            samples.append(f"{rng.randrange(10 ** 16, 10 ** 17)}X")
+        elif kind == 1:
+            samples.append(f"{rng.randrange(10 ** 17, 10 ** 18)}")
+        elif kind == 2:
+            samples.append(rng.randrange(10 ** 15, 10 ** 18))
+        else:
+            samples.append(None)
+    return pd.Series(samples, dtype=object, name="身份证号")
+
+
+def bench_mask(args):
+    """对比逐单元格 anonymize_data 与列式 anonymize_column"""
+    series = make_sensitive_cells(args.cells)
+    print(f"脱敏基准: {len(series):,} 个单元格")
+
+    legacy, legacy_time = timed(series.apply, EXCEL.anonymize_data)
+    columnar, columnar_time = timed(EXCEL.anonymize_column, series)
+
+    print(f"  逐单元格 apply : {legacy_time:8.3f}s")
+    print(f"  列式脱敏       : {columnar_time:8.3f}s")
+    print(f"  结果不一致     : {int((legacy != columnar).sum())}")
+
+
+# ===================== 合并 =====================
+def make_branch_frames(files, rows, seed=0):
+    """生成多个分公司的已处理工资表（部分文件缺少某些列）"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for file_idx in range(files):
+        df = pd.DataFrame({
+            "姓名": [f"员工{file_idx}_{i}" for i in range(rows)],
+            "工号": np.arange(rows) + file_idx * rows,
+            "部门": rng.choice(["财务部", "人事部", "研发部", "销售部", "行政部"], rows),
+            "基本工资": rng.uniform(3000, 30000, rows).round(2),
+            "社保": rng.uniform(300, 3000, rows).round(2),
+            "实发工资": rng.uniform(3000, 30000, rows).round(2),
+            "邮箱": [f"e{file_idx}_{i}@example.com" for i in range(rows)],
+        })
+        if file_idx % 3:
+            df["绩效工资"] = rng.uniform(0, 5000, rows).round(2)
+        if file_idx % 4 == 0:
+            df["备注"] = rng.choice(["", "试用期", "调岗"], rows)
+        df["数据来源"] = f"分公司{file_idx:02d}"
+        frames.append(df)
+    return frames
+
+
+def legacy_merge(all_dfs):
+    """旧版合并方式：逐列补 NaN 后拼接，再整体 fillna(0)"""
+    all_columns = set()
+    for df in all_dfs:
+        all_columns.update(df.columns)
+    for df in all_dfs:
+        for col in all_columns:
+            if col not in df.columns:
+                df[col] = np.nan
+    merged_df = pd.concat(all_dfs, ignore_index=True)
+    merged_df.fillna(0, inplace=True)
+    return merged_df
+
+
+def bench_merge(args):
+    """对比旧版合并与 merge_frames 的耗时和内存占用"""
+    print(f"合并基准: {args.files} 个文件 × {args.rows:,} 行")
+
+    legacy, legacy_time = timed(legacy_merge, make_branch_frames(args.files, args.rows))
+    concatenated, concat_time = timed(pd.concat, make_branch_frames(args.files, args.rows),
+                                      ignore_index=True, sort=False)
+    merged, compact_time = timed(EXCEL.compact_dtypes, concatenated)
+
+    legacy_mb = legacy.memory_usage(deep=True).sum() / 1024 / 1024
+    merged_mb = merged.memory_usage(deep=True).sum() / 1024 / 1024
+    print(f"  旧版 补列+拼接+fillna : {legacy_time:8.3f}s {legacy_mb:10.1f}MB")
+    print(f"  并集拼接              : {concat_time:8.3f}s")
+    print(f"  压缩数据类型          : {compact_time:8.3f}s {merged_mb:10.1f}MB")
+    print(f"  内存压缩比            : {legacy_mb / merged_mb:8.1f}x")
+
+
+# ===================== 导出 =====================
+def bench_export(args):
+    """对比 to_excel + beautify_excel 与边写边格式化的 write_excel_formatted"""
+    df = EXCEL.merge_frames(make_branch_frames(args.files, args.rows // args.files))
+    print(f"导出基准: {len(df):,} 行 × {len(df.columns)} 列")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.xlsx")
+        _, write_time = timed(df.to_excel, legacy_path, index=False)
+        _, beautify_time = timed(EXCEL.beautify_excel, legacy_path)
+        _, streaming_time = timed(EXCEL.write_excel_formatted, df, os.path.join(tmp, "streaming.xlsx"))
+
+    print(f"  to_excel + beautify_excel : {write_time:7.2f}s + {beautify_time:7.2f}s")
+    print(f"  write_excel_formatted     : {streaming_time:7.2f}s")
+    print(f"  加速比                    : {(write_time + beautify_time) / streaming_time:7.1f}x")
+
+
+# ===================== 工资表读取 =====================
+SURNAMES = list("王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗")
+GIVEN_NAMES = ["伟", "芳", "娜", "敏", "静", "丽", "强", "磊", "军", "洋", "勇", "艳", "杰", "娟", "涛", "明", "超", "秀英"]
+DEPARTMENTS = ["财务部", "人事部", "研发部", "销售部", "行政部", "市场部"]
+
+
+def messy_amounts(rng, amounts):
+    """把金额写成 HR 表格里常见的各种样子：带千分位、全角逗号、万为单位或纯数字"""
+    kinds = rng.integers(0, 5, len(amounts))
+    cells = []
+    for kind, amount in zip(kinds.tolist(), amounts.tolist()):
+        if kind == 0:
+            cells.append(f"{amount:,.2f}")
+        elif kind == 1:
+            cells.append(f"{amount:,.0f}".replace(",", "，"))
+        elif kind == 2:
+            cells.append(f"{amount / 10000:.2f}万")
+        elif kind == 3:
+            cells.append(f" {amount:.2f} ")
+        else:
+            cells.append(amount)
+    return cells
+
+
+def messy_dates(rng, count):
+    """入职日期：大多为“2020年3月5日”，夹杂斜杠和横线写法"""
+    years = rng.integers(2005, 2025, count).tolist()
+    months = rng.integers(1, 13, count).tolist()
+    days = rng.integers(1, 29, count).tolist()
+    kinds = rng.integers(0, 10, count).tolist()
+    return [
+        f"{y}/{m:02d}/{d:02d}" if kind == 0 else f"{y}-{m:02d}-{d:02d}" if kind == 1 else f"{y}年{m}月{d}日"
+        for y, m, d, kind in zip(years, months, days, kinds)
+    ]
+
+
+def make_messy_payroll(rows, branch=0, seed=0):
+    """生成一个分公司格式混杂的工资表（全部为原始单元格值）"""
+    rng = np.random.default_rng(seed + branch)
+    numbers = np.arange(rows)
+    base = rng.uniform(3000, 30000, rows).round(2)
+    bonus = rng.uniform(0, 8000, rows).round(2)
+    social = (base * 0.105).round(2)
+    return pd.DataFrame({
+        "姓名": [s + g for s, g in zip(rng.choice(SURNAMES, rows), rng.choice(GIVEN_NAMES, rows))],
+        "工号": [f"B{branch:02d}{n:07d}" for n in numbers.tolist()],
+        "部门": rng.choice(DEPARTMENTS, rows),
+        "身份证号": [f"{n}{'X' if n % 11 == 0 else n % 10}"
+                 for n in rng.integers(10 ** 16, 10 ** 17, rows).tolist()],
+        "银行卡号": [str(n) for n in rng.integers(6 * 10 ** 18, 7 * 10 ** 18, rows, dtype=np.int64).tolist()],
+        "基本工资": messy_amounts(rng, base),
+        "绩效工资": messy_amounts(rng, bonus),
+        "社保": messy_amounts(rng, social),
+        "实发工资": (base + bonus - social).round(2),
+        "入职日期": messy_dates(rng, rows),
+        "邮箱": [f"b{branch}_{n}@example.com" for n in numbers.tolist()],
+    })
+
+
+def write_messy_payroll(path, df, encoding="utf-8"):
+    """写出带标题行的工资表：公司名、制表信息和空行在表头之上"""
+    title_rows = [[f"XX科技有限公司{os.path.basename(path).split('.')[0]}工资表"], ["制表：财务部", "", "单位：元"], []]
+    if path.endswith(".csv"):
+        with open(path, "w", encoding=encoding, newline="") as f:
+            for row in title_rows:
+                f.write(",".join(row) + "\r\n")
+            df.to_csv(f, index=False, lineterminator="\r\n")
+        return
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("工资表")
+    for row in title_rows:
+        ws.append(row)
+    ws.append(list(df.columns))
+    for values in df.itertuples(index=False, name=None):
+        ws.append(values)
+    wb.save(path)
+
+
+def write_branch_files(folder, rows, files, fmt, seed=0):
+    """把 rows 行数据平均分到 files 个分公司文件；CSV 交替使用 GBK 与 UTF-8 编码"""
+    paths = []
+    for branch in range(files):
+        path = os.path.join(folder, f"分公司{branch:02d}_{rows}.{fmt}")
+        encoding = "gbk" if branch % 2 == 0 else "utf-8"
+        write_messy_payroll(path, make_messy_payroll(rows // files, branch, seed), encoding)
+        paths.append(path)
+    return paths
+
+
+def read_csv_whole(file_path):
+    """不分块读取整个CSV（大文件分块读取的对照）"""
+    EXCEL.Config.CSV_STREAM_MB = float("inf")
+    return EXCEL.process_single_file(file_path)
+
+
+def check_csv_streaming(file_path, max_rss=None):
+    """在独立进程中比较整表读取与分块读取/写出的峰值内存，分块峰值超过 max_rss（MB）时退出码非零"""
+    size_mb = os.path.getsize(file_path) / 1024 / 1024
+    out_path = file_path + ".stream.csv"
+    peaks = {}
+    for name, func, func_args in [("CSV 整表读取", read_csv_whole, (file_path,)),
+                                  ("read_csv_streaming", EXCEL.read_csv_streaming, (file_path,)),
+                                  ("process_csv_streaming", EXCEL.process_csv_streaming, (file_path, out_path))]:
+        rows, seconds, peaks[name] = run_isolated(func, *func_args)
+        print(f"  {name:<22}: {seconds:8.2f}s  峰值内存 {format_mb(peaks[name])}（独立进程，{size_mb:.0f}MB，{rows:,}条）")
+    os.remove(out_path)
+    streamed = peaks["process_csv_streaming"]
+    if max_rss and streamed is not None and streamed > max_rss:
+        print(f"  流式处理峰值内存 {streamed:.0f}MB 超过上限 {max_rss}MB")
+        sys.exit(1)
+
+
+def bench_ingest(args):
+    """按阶段计时读取、合并、保存和美化，并记录峰值内存"""
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def stage(name, func, *func_args, **func_kwargs):
+        # 每个阶段单独统计：本进程峰值从阶段开始时重新计算，进程池子进程按 PSS 与本进程合计
+        reset_peak_rss()
+        with MemorySampler() as sampler:
+            result, seconds = timed(func, *func_args, **func_kwargs)
+        total = f"，含子进程合计 {format_mb(sampler.peak)}" if sampler.children else ""
+        print(f"  {name:<22}: {seconds:8.2f}s  峰值内存 {format_mb(process_peak_mb())}{total}")
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        EXCEL.Config.CACHE_DIR = os.path.join(tmp, "cache")
+        for rows in args.rows:
+            for fmt in args.formats:
+                folder = os.path.join(tmp, f"{fmt}_{rows}")
+                os.makedirs(folder)
+                print(f"读取基准: {rows:,} 行 {fmt.upper()}，分 {args.files} 个文件")
+                paths = stage("生成测试文件", write_branch_files, folder, rows, args.files, fmt)
+                stage("process_single_file", EXCEL.process_single_file, paths[0])
+                if fmt == "csv":
+                    check_csv_streaming(paths[0], args.max_stream_rss)
+                merged = stage("merge_all_files", EXCEL.merge_all_files, paths, workers=args.workers)
+                stage("merge_all_files（缓存）", EXCEL.merge_all_files, paths, workers=args.workers)
+                stage("save_merged_data", EXCEL.save_merged_data, merged, folder, streaming=True)
+                if rows <= args.beautify_limit:
+                    legacy_path = os.path.join(folder, "legacy.xlsx")
+                    stage("to_excel", merged.to_excel, legacy_path, index=False)
+                    stage("beautify_excel", EXCEL.beautify_excel, legacy_path)
+                else:
+                    print(f"  {'beautify_excel':<22}: 跳过（超过 --beautify-limit）")
+
+
+# ===================== 工资条生成 =====================
+def bench_payslips(args):
+    """对比逐员工 generate_employee_salary_sheet 与批量 render_payslips"""
+    for employees in args.employees:
+        df = EXCEL.merge_frames(make_branch_frames(1, employees))
+        print(f"工资条生成基准: {employees:,} 名员工")
+
+        if employees <= args.legacy_limit:
+            with tempfile.TemporaryDirectory() as tmp:
+                _, legacy_time = timed(lambda: [EXCEL.generate_employee_salary_sheet(row, tmp)
+                                                for _, row in df.iterrows()])
+            print(f"  逐员工写临时文件 : {legacy_time:8.2f}s {employees / legacy_time:8.0f} 份/s")
+        else:
+            print(f"  逐员工写临时文件 : 跳过（超过 --legacy-limit）")
+
+        for workers in sorted({1, args.workers}):
+            attachments, batch_time = timed(EXCEL.render_payslips, df, workers=workers)
+            size_mb = sum(len(content) for content in attachments.values()) / 1024 / 1024
+            print(f"  批量生成 {workers} 进程  : {batch_time:8.2f}s {employees / batch_time:8.0f} 份/s "
+                  f"{len(attachments):,} 份 {size_mb:.1f}MB")
+
+
+# ===================== 邮件发送 =====================
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    """最小化的 SMTP 会话：接受任意登录，可注入延迟、限流回复和断线"""
+
+    def reply(self, text):
+        self.wfile.write(text.encode("utf-8") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.count("connections")
+        self.reply("220 localhost ESMTP")
+        delivered = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME")
+            elif command.startswith("AUTH"):
+                server.count("logins")
+                self.reply("235 2.7.0 Authentication successful")
+            elif command.startswith("MAIL"):
+                if server.throttle_every and server.count("mail_commands") % server.throttle_every == 0:
+                    server.count("throttled")
+                    self.reply("451 4.7.1 Too many messages, slow down")
+                else:
+                    self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                time.sleep(server.latency)
+                server.count("messages")
+                delivered += 1
+                self.reply("250 OK queued")
+                if server.disconnect_every and delivered % server.disconnect_every == 0:
+                    server.count("disconnects")
+                    return
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """本机 SMTP 替身服务器，统计连接、登录、邮件、限流和断线次数"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, throttle_every=0, disconnect_every=0):
+        super().__init__(("127.0.0.1", 0), LocalSMTPHandler)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.disconnect_every = disconnect_every
+        self.counters = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            return self.counters[name]
+
+
+def bench_smtp(args):
+    """用本机 SMTP 替身驱动 send_salary_emails，统计吞吐、连接数、重试和内存"""
+    # 断线重连、限流重试的告警会刷屏，只保留错误日志
+    logging.getLogger().setLevel(logging.ERROR)
+    server = LocalSMTPServer(args.latency, args.throttle_every, args.disconnect_every)
+    EXCEL.Config.SMTP_BACKOFF_START = args.backoff
+    print(f"邮件发送基准: 延迟 {args.latency}s, 每 {args.throttle_every or '-'} 封限流, "
+          f"每 {args.disconnect_every or '-'} 封断线, 每分钟限 {args.per_minute:,} 封")
+    print(f"  {'人数':>6} {'连接':>4} {'成功':>6} {'耗时':>8} {'封/秒':>8} {'建连':>4} {'断线重连':>6} "
+          f"{'限流重试':>6} {'峰值内存':>8}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        EXCEL.Config.DB_FILE = os.path.join(tmp, "ledger.db")
+        for employees in args.employees:
+            df = EXCEL.merge_frames(make_branch_frames(1, employees))
+            for workers in args.workers:
+                server.counters.clear()
+                smtp_config = {
+                    "server": "127.0.0.1", "port": server.server_address[1],
+                    "email": "payroll@example.com", "password": "secret",
+                    "sender_name": "财务部", "company_name": "基准测试公司", "hr_contact": "HR 0000",
+                    "per_minute": args.per_minute, "workers": workers,
+                }
+                stats = {}
+                reset_peak_rss()
+                (success, _), seconds = timed(EXCEL.send_salary_emails, df, smtp_config, stats=stats)
+                peak = process_peak_mb()
+                print(f"  {employees:>8,} {workers:>6} {success:>8,} {seconds:>9.2f}s {success / seconds:>9.1f} "
+                      f"{server.counters.get('connections', 0):>6} {stats['reconnects']:>10} "
+                      f"{stats['throttles']:>10} {format_mb(peak):>10}")
+    server.shutdown()
+
+
+# ===================== 启动耗时 =====================
+# 启动时不应导入的重型依赖（顶层包名）
+HEAVY_MODULES = ["pandas", "numpy", "openpyxl", "pyarrow", "PIL", "tkinter", "smtplib", "tqdm"]
+
+
+def run_import_probe(statement):
+    """在新的解释器中执行 statement 并计时，用 -X importtime 记录导入的模块；
+    返回 (毫秒, {模块: 累计微秒})，模块名保留缩进（每层两个空格）"""
+    code = ("import time\n_start = time.perf_counter()\n" + statement +
+            "\nprint((time.perf_counter() - _start) * 1000)")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(EXCEL.__file__)), check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.rstrip()[1:]] = int(cumulative)
+    return float(result.stdout.strip().splitlines()[-1]), modules
+
+
+def bench_importtime(args):
+    probes = [
+        ("import EXCEL", "import EXCEL"),
+        ("启动图形界面所需导入", "import EXCEL\nEXCEL.import_gui_modules()"),
+        ("后台预加载依赖", "import EXCEL\nEXCEL.warm_up_imports()"),
+    ]
+    print(f"启动耗时基准: 每项 {args.runs} 次取中位数")
+    results = {}
+    for label, statement in probes:
+        runs = [run_import_probe(statement) for _ in range(args.runs)]
+        results[label] = (statistics.median(ms for ms, _ in runs), runs[-1][1])
+        print(f"  {label}: {results[label][0]:.0f}ms")
+
+    median_ms, modules = results["import EXCEL"]
+    heavy = sorted({name.strip().split(".")[0] for name in modules} & set(HEAVY_MODULES))
+    print(f"  import 时加载的重型依赖: {', '.join(heavy) if heavy else '无'}")
+    # EXCEL 直接导入的模块（缩进一层）
+    direct = sorted(((us, name.strip()) for name, us in modules.items()
+                     if name.startswith("  ") and not name.startswith("   ")), reverse=True)
+    print("  EXCEL 最慢的直接导入: " + ", ".join(f"{name} {us / 1000:.0f}ms" for us, name in direct[:5]))
+
+    failed = bool(heavy)
+    if args.max_ms is not None and median_ms > args.max_ms:
+        print(f"  import EXCEL 耗时 {median_ms:.0f}ms 超过上限 {args.max_ms}ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="工资表处理系统性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    numbers = subparsers.add_parser("numbers", help="工资数字解析")
+    numbers.add_argument("--cells", type=int, default=1_000_000)
+    numbers.add_argument("--distinct", type=int, default=20_000)
+    numbers.set_defaults(func=bench_numbers)
+
+    dates = subparsers.add_parser("dates", help="日期解析")
+    dates.add_argument("--cells", type=int, default=1_000_000)
+    dates.set_defaults(func=bench_dates)
+
+    mask = subparsers.add_parser("mask", help="敏感信息脱敏")
+    mask.add_argument("--cells", type=int, default=1_000_000)
+    mask.set_defaults(func=bench_mask)
+
+    merge = subparsers.add_parser("merge", help="多文件合并")
+    merge.add_argument("--files", type=int, default=40)
+    merge.add_argument("--rows", type=int, default=25_000)
+    merge.set_defaults(func=bench_merge)
+
+    export = subparsers.add_parser("export", help="合并结果导出")
+    export.add_argument("--files", type=int, default=40)
+    export.add_argument("--rows", type=int, default=100_000)
+    export.set_defaults(func=bench_export)
+
+    ingest = subparsers.add_parser("ingest", help="工资表读取、合并与保存")
+    ingest.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ingest.add_argument("--formats", nargs="+", choices=["csv", "xlsx"], default=["csv", "xlsx"])
+    ingest.add_argument("--files", type=int, default=4)
+    ingest.add_argument("--workers", type=int, default=EXCEL.Config.MERGE_WORKERS)
+    ingest.add_argument("--beautify-limit", type=int, default=100_000)
+    ingest.add_argument("--max-stream-rss", type=float, default=None,
+                        help="流式处理CSV的峰值内存上限（MB），超过时返回非零退出码")
+    ingest.set_defaults(func=bench_ingest)
+
+    payslips = subparsers.add_parser("payslips", help="工资条批量生成")
+    payslips.add_argument("--employees", type=int, nargs="+", default=[1_000, 10_000, 50_000])
+    payslips.add_argument("--workers", type=int, default=EXCEL.Config.RENDER_WORKERS)
+    payslips.add_argument("--legacy-limit", type=int, default=10_000)
+    payslips.set_defaults(func=bench_payslips)
+
+    smtp = subparsers.add_parser("smtp", help="邮件发送（本机 SMTP 替身）")
+    smtp.add_argument("--employees", type=int, nargs="+", default=[100, 1_000, 10_000])
+    smtp.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    smtp.add_argument("--latency", type=float, default=0.0, help="每封邮件 DATA 后的服务器延迟（秒）")
+    smtp.add_argument("--throttle-every", type=int, default=0, help="每 N 个 MAIL 命令返回一次 451")
+    smtp.add_argument("--disconnect-every", type=int, default=0, help="每个连接发送 N 封后断开")
+    smtp.add_argument("--per-minute", type=int, default=1_000_000, help="限速器每分钟发送上限")
+    smtp.add_argument("--backoff", type=float, default=0.1, help="限流后的起始退避秒数")
+    smtp.set_defaults(func=bench_smtp)
+
+    importtime = subparsers.add_parser("importtime", help="启动耗时（-X importtime）")
+    importtime.add_argument("--runs", type=int, default=5)
+    importtime.add_argument("--max-ms", type=float, default=None, help="import EXCEL 耗时上限，超过时返回非零退出码")
+    importtime.set_defaults(func=bench_importtime)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()